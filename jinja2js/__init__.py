@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 from jinja2.ext import Extension
 
-from compiler import CodeGenerator
+from compiler import CodeGenerator, Scope, Workers, runtime_version
+from extends import CompileError
+from cache import FileSystemCache, SQLiteCache, MemoryCache
+from graph import DependencyGraph
+from build import Builder
 from filters import default_filters
 from tests import default_tests
 from utils import default_utils
@@ -17,14 +21,26 @@ class Jinja2JS(Extension):
 	def bind(self, env):
 		def compile_js(templates=None, source=None,
 		               scope=None, stream=None,
-		               extensions=None, filter_func=None):
+		               extensions=None, filter_func=None, cache=None,
+		               workers=None, runtime=False, **options):
 			if templates is None and source is None:
 				templates = env.loader.list_templates(extensions, filter_func)
-			generator = CodeGenerator(env, scope, stream)
-			generator.generate(templates=templates, source=source)
+			if cache is None:
+				cache = env.js_cache
+			generator = CodeGenerator(env, scope, stream, cache, options)
+			generator.generate(templates=templates, source=source, workers=workers,
+			                   runtime=runtime_version(env) if runtime else None)
+			if stream is None:
+				return generator.stream.getvalue()
+
+		def compile_js_runtime(stream=None, **options):
+			generator = CodeGenerator(env, stream=stream, options=options)
+			generator.generate_runtime(runtime_version(env))
 			if stream is None:
 				return generator.stream.getvalue()
 		env.extend(compile_js=compile_js,
+		           compile_js_runtime=compile_js_runtime,
+		           js_cache=None,
 		           filters_js=default_filters.copy(),
 		           tests_js=default_tests.copy(),
 		           utils_js=default_utils.copy())
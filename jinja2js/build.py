@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+from hashlib import sha1
+from json import dumps
+from logging import getLogger, NullHandler
+
+from jinja2.exceptions import TemplateError, TemplateNotFound
+
+from cache import MemoryCache
+from extends import CompileError
+from compiler import CodeGenerator, Workers, source_checksum, resolve_helpers, runtime_version
+from graph import DependencyGraph
+
+__all__ = ['Builder']
+
+
+logger = getLogger('jinja2js')
+logger.addHandler(NullHandler())
+
+
+def write_file(filename, code):
+	if isinstance(code, unicode):
+		code = code.encode('utf-8')
+	if not os.path.isdir(os.path.dirname(filename)):
+		os.makedirs(os.path.dirname(filename))
+	with open(filename, 'wb') as f:
+		f.write(code)
+
+
+class Builder(object):
+
+	def __init__(self, environment, bundles=None, directory='.', graph=None,
+	             cache=None, workers=None, runtime=None, options=None, measure=False):
+		self.environment = environment
+		self.options = options
+		# minified bundles are compared with unminified builds of them
+		self.measure = measure
+		self.workers = workers
+		self.runtime = runtime
+		self.bundles = bundles or {}
+		self.directory = directory
+		if not isinstance(graph, DependencyGraph):
+			graph = DependencyGraph(graph)
+		self.graph = graph
+		# unchanged templates of a stale bundle are taken from the cache
+		if cache is None:
+			cache = environment.js_cache or MemoryCache()
+		self.cache = cache
+		self.uptodate = {}
+		# sources of the tracked templates whose loader can't tell if they
+		# are up to date
+		self.checksums = {}
+		self.pending = set()
+		# bytes saved by minifying, per bundle, when measured
+		self.savings = {}
+
+	def build(self, changed=None):
+		if changed is None:
+			changed = self.graph.changed(self.environment)
+		stale = self.graph.stale_bundles(self.bundles, set(changed))
+		for bundle in self.bundles:
+			if not os.path.exists(os.path.join(self.directory, bundle)):
+				stale.add(bundle)
+		version = None
+		if self.runtime is not None:
+			# bundles are stamped with the runtime version they need
+			version = runtime_version(self.environment)
+			if (self.graph.runtime != version or
+			    not os.path.exists(os.path.join(self.directory, self.runtime))):
+				generator = CodeGenerator(self.environment, options=self.options)
+				generator.generate_runtime(version)
+				self.write(self.runtime, generator.stream.getvalue())
+				stale.update(self.bundles)
+			self.graph.runtime = version
+		# one pool of processes for all the bundles
+		with Workers(self.environment, self.workers) as workers:
+			for bundle in sorted(stale):
+				self.build_bundle(bundle, version, workers)
+		self.graph.update_helpers(self.environment)
+		if self.graph.filename is not None:
+			self.graph.save()
+		return stale
+
+	def build_bundle(self, bundle, runtime=None, workers=None):
+		if workers is None:
+			workers = self.workers
+		templates = self.bundles[bundle]
+		generator = CodeGenerator(self.environment, cache=self.cache, options=self.options)
+		generator.generate(templates=templates, workers=workers, runtime=runtime)
+		for fragment in generator.fragments:
+			self.graph.update(fragment)
+		self.uptodate.update(generator.uptodate)
+		for name in generator.uptodate:
+			self.checksums.pop(name, None)
+		self.graph.bundles[bundle] = sorted(templates)
+		code = generator.stream.getvalue()
+		self.write(bundle, code)
+		if generator.minify and self.measure:
+			# compiled once more unminified, mostly from the cache
+			plain = CodeGenerator(self.environment, cache=self.cache,
+			                      options=dict(self.options, minify=False))
+			plain.generate(templates=templates, workers=workers, runtime=runtime)
+			self.savings[bundle] = len(plain.stream.getvalue()) - len(code)
+			logger.info('Minified %s to %d bytes, %d bytes saved', bundle, len(code),
+			            self.savings[bundle])
+
+	## splitting ##
+
+	def split(self, templates=None, manifest='manifest.json', loader=None, base=''):
+		if templates is None:
+			templates = self.environment.list_templates()
+		generator = CodeGenerator(self.environment, cache=self.cache, options=self.options)
+		fragments = generator.collect_templates(templates, self.workers)
+
+		# helpers are grouped by the templates using them, so that every
+		# group is loaded by exactly the same set of templates
+		helpers, users = {}, {}
+		for fragment in fragments:
+			self.graph.update(fragment)
+			helpers[fragment.name] = resolve_helpers(
+				self.environment, self.graph.helper_depends(fragment.name))
+			for helper in helpers[fragment.name]:
+				users.setdefault(helper, set()).add(fragment.name)
+		groups = {}
+		for helper, names in users.items():
+			groups.setdefault(frozenset(names), set()).add(helper)
+
+		files = {}
+		for group in groups.values():
+			filename = 'helpers/%s.js' % sha1(' '.join(sorted(group))).hexdigest()[:12]
+			generator = CodeGenerator(self.environment, options=self.options)
+			generator.begin_bundle()
+			aliases = {}
+			for helper in resolve_helpers(self.environment, group):
+				if helper in group:
+					generator.generate_helper(helper, aliases)
+					files[helper] = filename
+			generator.end_bundle()
+			self.write(filename, generator.stream.getvalue())
+
+		for fragment in fragments:
+			generator = CodeGenerator(self.environment, options=self.options)
+			generator.begin_bundle()
+			generator.write_fragment(fragment)
+			generator.end_bundle()
+			self.write('templates/%s.js' % fragment.name, generator.stream.getvalue())
+
+		requires = {}
+		for fragment in fragments:
+			names = sorted(self.graph.dependencies([fragment.name]))
+			required = set(files[helper] for name in names for helper in helpers[name])
+			requires[fragment.name] = (sorted(required) +
+			                           ['templates/%s.js' % name for name in names])
+		self.write(manifest, dumps({'templates': requires}, indent=1, sort_keys=True))
+		if loader is not None:
+			self.write(loader, self.generate_loader(requires, base))
+		if self.graph.filename is not None:
+			self.graph.save()
+		return requires
+
+	def generate_loader(self, requires, base):
+		generator = CodeGenerator(self.environment, options=self.options)
+		generator.begin_bundle()
+		generator.line('Jinja.manifest = %s;' % dumps({'base': base, 'templates': requires},
+		                                              sort_keys=True))
+		for helper in resolve_helpers(self.environment, ['utils.render']):
+			generator.generate_helper(helper)
+		generator.line('Jinja.load = Jinja.utils.load;')
+		generator.line('Jinja.render = Jinja.utils.render;')
+		generator.end_bundle()
+		return generator.stream.getvalue()
+
+	def write(self, filename, code):
+		write_file(os.path.join(self.directory, filename), code)
+
+	## watching ##
+
+	def track(self, names):
+		for name in names:
+			try:
+				source, _, uptodate = self.environment.loader.get_source(self.environment, name)
+			except TemplateNotFound:
+				self.uptodate.pop(name, None)
+				self.checksums.pop(name, None)
+				continue
+			self.uptodate[name] = uptodate
+			if uptodate is None:
+				self.checksums[name] = source_checksum(source)
+
+	def changed(self):
+		changed = set()
+		for name, uptodate in self.uptodate.items():
+			if uptodate is not None:
+				if not uptodate():
+					changed.add(name)
+				continue
+			# the loader can't tell, so compare the sources
+			try:
+				source, _, _ = self.environment.loader.get_source(self.environment, name)
+			except TemplateNotFound:
+				changed.add(name)
+				continue
+			checksum = self.checksums.get(name)
+			if checksum is None:
+				node = self.graph.templates.get(name)
+				checksum = node and node['checksum']
+			if checksum != source_checksum(source):
+				changed.add(name)
+		return changed
+
+	def update(self):
+		changed = self.changed()
+		if not changed:
+			return set()
+		changed.update(self.pending)
+		try:
+			stale = self.build(changed)
+		except (TemplateError, CompileError):
+			logger.exception('Failed to rebuild %s', ', '.join(sorted(changed)))
+			# wait for the next change of these templates and retry then
+			self.pending = changed
+			self.track(changed)
+			return set()
+		self.pending = set()
+		# changed templates no stale bundle depends on are seen as well
+		self.track(changed)
+		return stale
+
+	def watch(self, interval=0.2, callback=None):
+		self.build()
+		names = set()
+		for templates in self.bundles.values():
+			names.update(self.graph.dependencies(templates))
+		self.track(names.difference(self.uptodate))
+		while True:
+			time.sleep(interval)
+			stale = self.update()
+			if stale and callback is not None:
+				callback(stale)
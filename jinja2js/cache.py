@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import tempfile
+from collections import OrderedDict
+
+__all__ = ['FileSystemCache', 'SQLiteCache', 'MemoryCache']
+
+
+# a cache of compiled templates is any object with `load(key)`, returning
+# the string stored for the key or None, `dump(key, value)` and `clear()`.
+# the keys are made by `compiler.cache_key`
+
+
+class FileSystemCache(object):
+
+	def __init__(self, directory=None, pattern='__jinja2js_%s.cache'):
+		if directory is None:
+			directory = os.path.join(tempfile.gettempdir(), '_jinja2js-cache')
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.directory = directory
+		self.pattern = pattern
+
+	def _get_filename(self, key):
+		return os.path.join(self.directory, self.pattern % key)
+
+	def load(self, key):
+		try:
+			with open(self._get_filename(key), 'rb') as f:
+				return f.read()
+		except IOError:
+			return None
+
+	def dump(self, key, value):
+		# write through a temporary file, so that concurrent builds never
+		# read a half written entry
+		fd, tmp = tempfile.mkstemp(dir=self.directory)
+		with os.fdopen(fd, 'wb') as f:
+			f.write(value)
+		os.rename(tmp, self._get_filename(key))
+
+	def clear(self):
+		prefix, suffix = self.pattern.split('%s')
+		for filename in os.listdir(self.directory):
+			if filename.startswith(prefix) and filename.endswith(suffix):
+				os.remove(os.path.join(self.directory, filename))
+
+
+class SQLiteCache(object):
+
+	def __init__(self, filename):
+		self.filename = filename
+		self._connection = None
+
+	@property
+	def connection(self):
+		if self._connection is None:
+			self._connection = sqlite3.connect(self.filename)
+			self._connection.execute('CREATE TABLE IF NOT EXISTS fragments '
+			                         '(key TEXT PRIMARY KEY, value TEXT)')
+		return self._connection
+
+	def load(self, key):
+		row = self.connection.execute('SELECT value FROM fragments WHERE key = ?',
+		                              (key,)).fetchone()
+		if row is not None:
+			return str(row[0])
+
+	def dump(self, key, value):
+		with self.connection:
+			self.connection.execute('INSERT OR REPLACE INTO fragments VALUES (?, ?)',
+			                        (key, value))
+
+	def clear(self):
+		with self.connection:
+			self.connection.execute('DELETE FROM fragments')
+
+
+class MemoryCache(object):
+
+	def __init__(self, max_size=16 * 1024 * 1024):
+		self.max_size = max_size
+		self.size = 0
+		self.entries = OrderedDict()
+
+	def load(self, key):
+		value = self.entries.pop(key, None)
+		if value is not None:
+			# most recently used entries live at the end
+			self.entries[key] = value
+		return value
+
+	def dump(self, key, value):
+		if key in self.entries:
+			self.size -= len(self.entries.pop(key))
+		self.entries[key] = value
+		self.size += len(value)
+		while self.size > self.max_size and self.entries:
+			_, evicted = self.entries.popitem(last=False)
+			self.size -= len(evicted)
+
+	def clear(self):
+		self.entries.clear()
+		self.size = 0
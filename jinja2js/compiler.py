@@ -1,24 +1,409 @@
 # -*- coding: utf-8 -*-
 from StringIO import StringIO
 from copy import deepcopy
-from json import dumps
+from hashlib import sha1
+from multiprocessing import Pool
+from json import dumps, loads
 
-from jinja2 import nodes
-from jinja2.optimizer import optimize
-from jinja2.visitor import NodeVisitor
+from jinja2 import nodes, escape
+from jinja2.optimizer import Optimizer as _Optimizer
+from jinja2.visitor import NodeVisitor, NodeTransformer
 from jinja2.compiler import Frame as _Frame, EvalContext
-from jinja2.exceptions import TemplateAssertionError
+from jinja2.exceptions import TemplateAssertionError, TemplateNotFound
 
+from extends import Function, CompileError, _primitive
 
-def _get_template(env, name=None, source=None):
+
+def _get_source(env, name=None, source=None):
 	if name:
-		source, filename, _ = env.loader.get_source(env, name)
+		source, filename, uptodate = env.loader.get_source(env, name)
 	else:
-		name, filename = '<template>', '<template>'
+		name, filename, uptodate = '<template>', '<template>', None
+	return name, filename, source, uptodate
+
+
+def _unfolded(node):
+	return isinstance(node, (nodes.Filter, nodes.Test)) or \
+		node.find((nodes.Filter, nodes.Test)) is not None
+
+
+class Optimizer(_Optimizer):
+	# jinja folds filters with their python realization, which is only
+	# safe for helpers marked as pure and constants passing their guard
+
+	def visit_If(self, node):
+		node.test = self.visit(node.test)
+		if not _unfolded(node.test) and node.find(nodes.Block) is None:
+			try:
+				value = node.test.as_const()
+			except nodes.Impossible:
+				pass
+			else:
+				# a constant test leaves just one of the branches
+				result = []
+				for n in node.body if value else node.else_:
+					result.extend(self.visit_list(n))
+				return result
+		for field, value in node.iter_fields(exclude=('test',)):
+			if isinstance(value, list):
+				body = []
+				for n in value:
+					body.extend(self.visit_list(n))
+				setattr(node, field, body)
+		return node
+
+	def fold(self, node):
+		node = self.generic_visit(node)
+		if node.find((nodes.Filter, nodes.Test)) is not None:
+			return node
+		try:
+			return nodes.Const.from_untrusted(node.as_const(),
+			                                  lineno=node.lineno,
+			                                  environment=self.environment)
+		except nodes.Impossible:
+			return node
+
+	visit_Add = visit_Sub = visit_Mul = visit_Div = visit_FloorDiv = \
+	visit_Pow = visit_Mod = visit_And = visit_Or = visit_Pos = visit_Neg = \
+	visit_Not = visit_Compare = visit_Getitem = visit_Getattr = visit_Call = \
+	visit_CondExpr = fold
+
+	def fold_helper(self, node, helpers, realizations):
+		node = self.generic_visit(node)
+		helper, func = helpers.get(node.name), realizations.get(node.name)
+		if helper is None:
+			# without a javascript realization folding is the only way out
+			return self.fold(node)
+		if func is None or node.node is None or \
+		   node.dyn_args is not None or node.dyn_kwargs is not None:
+			return node
+		if not all(isinstance(n, nodes.Const)
+		           for n in [node.node] + node.args + [k.value for k in node.kwargs]):
+			return node
+		eval_ctx = nodes.get_eval_context(node, None)
+		if eval_ctx.volatile or getattr(func, 'contextfilter', False):
+			return node
+		value = node.node.value
+		args = [n.value for n in node.args]
+		kwargs = dict((k.key, k.value.value) for k in node.kwargs)
+		try:
+			if not helper.foldable(value, *args, **kwargs):
+				return node
+			if getattr(func, 'evalcontextfilter', False):
+				args.insert(0, eval_ctx)
+			elif getattr(func, 'environmentfilter', False):
+				args.insert(0, self.environment)
+			result = func(value, *args, **kwargs)
+		except Exception:
+			return node
+		if not _primitive(result):
+			return node
+		return nodes.Const(result, lineno=node.lineno, environment=self.environment)
+
+	def visit_Filter(self, node):
+		return self.fold_helper(node, self.environment.filters_js, self.environment.filters)
+
+	def visit_Test(self, node):
+		return self.fold_helper(node, self.environment.tests_js, self.environment.tests)
+
+
+def _merge_outputs(node):
+	# neighbouring outputs, e.g. left behind by dead branches, share one push
+	for field, value in node.iter_fields():
+		if not isinstance(value, list):
+			continue
+		body = []
+		for child in value:
+			if isinstance(child, nodes.Output) and body and isinstance(body[-1], nodes.Output):
+				body[-1] = nodes.Output(body[-1].nodes + child.nodes, lineno=body[-1].lineno)
+			else:
+				body.append(child)
+		setattr(node, field, body)
+	for child in node.iter_child_nodes():
+		_merge_outputs(child)
+	return node
+
+
+def _literal(node, eval_ctx):
+	# plain strings, adding to markup would escape again
+	if isinstance(node, nodes.TemplateData):
+		return unicode(node.as_const(eval_ctx))
+	if isinstance(node, nodes.Const) and not isinstance(node.value, (bool, float)) \
+	   and _primitive(node.value):
+		if eval_ctx.autoescape:
+			return unicode(escape(node.value))
+		return unicode(node.value)
+
+
+def _chunk_count(body):
+	count = 0
+	for node in body:
+		for n in [node] + list(node.find_all((nodes.Output, nodes.Include,
+		                                      nodes.Block, nodes.FilterBlock))):
+			count += len(n.nodes) if isinstance(n, nodes.Output) else 1
+	return count
+
+
+def _loop_fields(body):
+	# fields of `loop` read by the nodes, None stands for any other use.
+	# inside nested for bodies `loop` is the loop object of those loops
+	fields = set()
+	for node in body:
+		if isinstance(node, nodes.Getattr) and isinstance(node.node, nodes.Name) \
+		   and node.node.name == 'loop':
+			fields.add(node.attr)
+			continue
+		if isinstance(node, nodes.Name) and node.name == 'loop':
+			fields.add(None)
+			continue
+		if isinstance(node, nodes.For):
+			children = [node.iter] + [node.test] * (node.test is not None)
+		else:
+			children = node.iter_child_nodes()
+		fields.update(_loop_fields(children))
+	return fields
+
+
+# fields which need the number of items passing the loop filter
+length_fields = frozenset([None, 'length', 'revindex', 'revindex0', 'last'])
+
+
+def _constant_items(node):
+	# items of a constant list a javascript set compares the same as python
+	if isinstance(node, (nodes.List, nodes.Tuple)):
+		if not all(isinstance(item, nodes.Const) for item in node.items):
+			return None
+		values = [item.value for item in node.items]
+	elif isinstance(node, nodes.Const) and isinstance(node.value, (list, tuple)):
+		values = list(node.value)
+	else:
+		return None
+	for value in values:
+		if isinstance(value, bool) or not (value is None or _primitive(value)):
+			return None
+	return values
+
+
+def _simple(node):
+	# operands which are cheap and safe to evaluate twice
+	if isinstance(node, (nodes.Name, nodes.Const)):
+		return True
+	if isinstance(node, nodes.Getattr):
+		return _simple(node.node)
+	if isinstance(node, nodes.Getitem):
+		return _simple(node.node) and isinstance(node.arg, nodes.Const)
+	return False
+
+
+# macros and included templates writing at most this many chunks are
+# inlined at their call sites
+inline_limit = 16
+
+
+def _looped_includes(body, looped=False):
+	# names of the constant includes in loops, not looking into the macros
+	# and blocks which are functions of their own
+	found = []
+	for node in body:
+		if isinstance(node, (nodes.Macro, nodes.Block)):
+			continue
+		if looped and isinstance(node, nodes.Include) and isinstance(node.template, nodes.Const) \
+		   and isinstance(node.template.value, basestring):
+			found.append(node.template.value)
+		found.extend(_looped_includes(node.iter_child_nodes(),
+		                              looped or isinstance(node, nodes.For)))
+	return found
+
+
+def _free_names(node):
+	names = [node] if isinstance(node, nodes.Name) else []
+	names.extend(node.find_all(nodes.Name))
+	return set(n.name for n in names if n.ctx == 'load')
+
+
+def _clone(node):
+	# the copy shares the environment of the node, with its caches
+	environment = getattr(node, 'environment', None)
+	return deepcopy(node, {id(environment): environment})
+
+
+def _inlinable(body):
+	# small bodies only writing output, calling no macros and reading
+	# nothing but arguments and the context
+	if not all(isinstance(n, nodes.Output) for n in body):
+		return False
+	if _chunk_count(body) > inline_limit:
+		return False
+	for n in body:
+		if any(isinstance(call.node, nodes.Name) for call in n.find_all(nodes.Call)):
+			return False
+		if _free_names(n) & set(['loop', 'varargs', 'kwargs', 'caller']):
+			return False
+	return True
+
+
+class _Substitute(NodeTransformer):
+
+	def __init__(self, args):
+		self.args = args
+
+	def visit_Name(self, node):
+		if node.name in self.args:
+			return _clone(self.args[node.name])
+		return node
+
+
+class _Flatten(NodeTransformer):
+
+	def __init__(self, blocks):
+		self.blocks = blocks
+
+	def visit_Block(self, node):
+		# the most derived definition, with its nested blocks resolved too,
+		# scoped or not where it's placed
+		block = _clone(self.blocks[node.name])
+		block.scoped = node.scoped
+		return self.generic_visit(block)
+
+
+def _parse(env, name, filename, source):
 	ast = env._parse(source, name, filename)
 	if env.optimized:
-		ast = optimize(ast, env)
-	return name, filename, ast
+		ast = Optimizer(env).visit(ast)
+	return ast
+
+
+def source_checksum(source):
+	if isinstance(source, unicode):
+		source = source.encode('utf-8')
+	return sha1(source).hexdigest()
+
+
+def _get_template(env, name=None, source=None):
+	name, filename, source, _ = _get_source(env, name, source)
+	return name, filename, _parse(env, name, filename, source)
+
+
+registries = (('filters', 'filters_js'),
+              ('tests', 'tests_js'),
+              ('utils', 'utils_js'))
+
+kinds = {'filters': 'filter ', 'tests': 'test ', 'utils': ''}
+
+
+# code generation settings, they are part of the cache key of a template
+default_options = {'buffer': 'array', 'flatten': False, 'inline_includes': False,
+                   'minify': False, 'profile': False}
+
+buffers = ('array', 'string', 'chunks')
+
+
+def _options(options):
+	unknown = set(options or ()).difference(default_options)
+	if unknown:
+		raise TypeError('Unknown option %s' % ', '.join(sorted(unknown)))
+	options = dict(default_options, **(options or {}))
+	if options['buffer'] not in buffers:
+		raise TypeError('Unknown buffer strategy %s' % options['buffer'])
+	for option in 'flatten', 'inline_includes', 'minify', 'profile':
+		if not isinstance(options[option], bool):
+			raise TypeError('Option %s takes a boolean' % option)
+	return options
+
+
+def get_helper(environment, depend):
+	include, name = depend.split('.')
+	registry = getattr(environment, dict(registries)[include])
+	if name not in registry:
+		raise CompileError('Can\'t find javascript realization of %s%s' % (kinds[include], name))
+	return registry[name]
+
+
+def registry_checksum(registry):
+	checksum = sha1()
+	for name in sorted(registry):
+		checksum.update('%s=%s;' % (name, registry[name].fingerprint()))
+	return checksum.hexdigest()
+
+
+# environment settings which change the parsed template
+environment_options = ('block_start_string', 'block_end_string',
+                       'variable_start_string', 'variable_end_string',
+                       'comment_start_string', 'comment_end_string',
+                       'line_statement_prefix', 'line_comment_prefix',
+                       'trim_blocks', 'lstrip_blocks', 'newline_sequence',
+                       'keep_trailing_newline', 'optimized')
+
+
+def cache_key(environment, name, source, options=None):
+	from jinja2js import __version__
+	key = sha1(__version__)
+	for option in environment_options:
+		key.update('|%r' % (getattr(environment, option, None),))
+	autoescape = environment.autoescape
+	if callable(autoescape):
+		autoescape = autoescape(name)
+	key.update('|%r|%r' % (autoescape, sorted((options or {}).items())))
+	for _, registry in registries:
+		key.update('|' + registry_checksum(getattr(environment, registry)))
+	key.update('|' + callables_checksum(environment.filters))
+	key.update('|' + callables_checksum(environment.tests))
+	key.update('|%s' % _utf8(name))
+	key.update('|' + source_checksum(source))
+	return key.hexdigest()
+
+
+def _code_checksum(checksum, code):
+	checksum.update(code.co_code)
+	for const in code.co_consts:
+		if hasattr(const, 'co_code'):
+			_code_checksum(checksum, const)
+		else:
+			checksum.update('|%r' % (const,))
+
+
+def callables_checksum(registry):
+	# python filters and tests are run when constants are folded
+	checksum = sha1()
+	for name in sorted(registry):
+		func = registry[name]
+		checksum.update('%s=%s.%s;' % (name, getattr(func, '__module__', None),
+		                               getattr(func, '__name__', None)))
+		code = getattr(func, '__code__', None)
+		if code is not None:
+			_code_checksum(checksum, code)
+	return checksum.hexdigest()
+
+
+def runtime_version(environment):
+	from jinja2js import __version__
+	checksum = sha1()
+	for _, registry in registries:
+		checksum.update(registry_checksum(getattr(environment, registry)))
+	return '%s-%s' % (__version__, checksum.hexdigest()[:8])
+
+
+def resolve_helpers(environment, depends):
+	# transitive closure of helpers, every helper after its dependencies
+	order, seen = [], set()
+
+	def visit(depend):
+		if depend in seen:
+			return
+		seen.add(depend)
+		helper = get_helper(environment, depend)
+		if not isinstance(helper, Function):
+			# inline helpers are written into the templates, there is
+			# nothing to call
+			include, name = depend.split('.')
+			raise CompileError('Can\'t call inline %s%s from javascript' % (kinds[include], name))
+		for sub in sorted(helper.depends):
+			visit(sub)
+		order.append(depend)
+
+	for depend in sorted(depends):
+		visit(depend)
+	return order
 
 
 class Dependencies(object):
@@ -42,6 +427,9 @@ class Dependencies(object):
 		return deepcopy(self)
 
 
+includes = ('templates', 'filters', 'tests', 'utils')
+
+
 class Scope(object):
 
 	def __init__(self):
@@ -63,6 +451,49 @@ class Scope(object):
 	def copy(self):
 		return deepcopy(self)
 
+	def depends(self):
+		return dict((include, sorted(getattr(self, include).undeclared))
+		            for include in includes)
+
+	def dump(self):
+		return dumps(dict((include, sorted(getattr(self, include).declared))
+		                  for include in includes), sort_keys=True)
+
+	@classmethod
+	def load(cls, s):
+		scope = cls()
+		for include, names in loads(s).items():
+			getattr(scope, include).declared.update(names)
+		return scope
+
+
+class Fragment(object):
+
+	def __init__(self, name, code, depends, parents=(), checksum=None, sources=None):
+		self.name = name
+		self.code = code
+		self.depends = depends
+		self.parents = list(parents)
+		self.checksum = checksum
+		# checksums of the other templates compiled into this one
+		self.sources = sources or {}
+
+	def use(self, scope):
+		for include, names in self.depends.items():
+			for name in names:
+				getattr(scope, include).use(name)
+
+	def dump(self):
+		return dumps({'name': self.name, 'code': self.code, 'depends': self.depends,
+		              'parents': self.parents, 'checksum': self.checksum,
+		              'sources': self.sources})
+
+	@classmethod
+	def load(cls, s):
+		data = loads(s)
+		return cls(data['name'], data['code'], data['depends'],
+		           data['parents'], data['checksum'], data.get('sources'))
+
 
 class Frame(_Frame):
 
@@ -73,72 +504,316 @@ class Frame(_Frame):
 		return n
 
 
+# shorter names of the internal variables and registries in minified code
+short_names = {'_buf': '_b', '_fbuf': '_f', '_loopvar': '_l', '_loopindex': '_i',
+               '_pre_loop': '_p', '_item': '_e', '_macro_': '_m', '_include': '_n',
+               '_in': '_s', '_cmp': '_c'}
+
+short_registries = [('Jinja.filters.', '_F.'), ('Jinja.tests.', '_T.'),
+                    ('Jinja.utils.', '_U.'), ('Jinja.templates[', '_J[')]
+
+
+def _utf8(code):
+	# the code is written as utf-8 bytes, whatever the stream is
+	if isinstance(code, unicode):
+		return code.encode('utf-8')
+	return code
+
+
+def _compact(body):
+	# without indentation, blank lines and comment lines. the other line
+	# breaks stay, the helpers may rely on semicolon insertion
+	lines = [line.strip() for line in body.split('\n')]
+	return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+
 operators = {'eq': '==',
              'ne': '!=',
              'gt': '>',
              'gteq': '>=',
              'lt': '<',
-             'lteq': '<=',
-             'in': 'in',  # todo: really?
-             'notin': 'not in'}  # todo: really?
+             'lteq': '<='}
+
+
+def _compile(environment, name, filename, source, indentation, options):
+	generator = CodeGenerator(environment, options=options)
+	generator.indentation = indentation
+	generator.visit_source(name, filename, source)
+	return Fragment(name, generator.stream.getvalue(),
+	                generator.scope.depends(), generator.parents,
+	                source_checksum(source), generator.sources)
+
+
+# set in every worker process by the pool initializer
+_worker_environment = None
+
+
+def _init_worker(environment):
+	global _worker_environment
+	_worker_environment = environment
+
+
+def _compile_worker(args):
+	try:
+		return _compile(_worker_environment, *args).dump()
+	except Exception:
+		return None
+
+
+class Workers(object):
+
+	# processes compiling templates, started on first use and shared by the
+	# generators of a build. the environment is passed to them by the pool
+	# initializer, it has to be picklable where processes aren't forked
+	def __init__(self, environment, processes=None):
+		self.environment = environment
+		self.processes = processes
+		self.pool = None
+
+	def map(self, args):
+		if not self.processes or self.processes < 2 or len(args) < 2:
+			return [None] * len(args)
+		if self.pool is None:
+			self.pool = Pool(self.processes, _init_worker, (self.environment,))
+		return self.pool.map(_compile_worker, args)
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
 
 
 class CodeGenerator(NodeVisitor):
 
-	def __init__(self, environment, scope=None, stream=None):
+	def __init__(self, environment, scope=None, stream=None, cache=None, options=None):
 		self.environment = environment
 		self.scope = scope or Scope()
 		self.stream = stream or StringIO()
+		self.cache = cache
+		self.options = _options(options)
+		self.fragments = []
+		self.uptodate = {}
+		self.parents = []
+		self.sources = {}
+		# blocks are written in place, see `flatten`
+		self.flat = False
+		# loop objects of the enclosing loops
+		self.loops = []
+		# names of the sets hoisted for `in` tests against constant lists
+		self.sets = {}
+		# macros of the template and the local functions realizing them
+		self.macros = {}
+		# bodies of included templates written in place, with the checksums
+		# of their sources, and the variables bound to the others
+		self.inlines = {}
+		self.includes = {}
+		self.autoescape = False
+		self.minify = self.options['minify']
+		self.profile = self.options['profile']
 		self.indentation = 0
 		self.new_line = True
 
-	def generate(self, templates=None, source=None):
-		self.line('var Jinja = Jinja || {templates:{}, filters:{}, tests:{}, utils:{}};')
-		self.begin('(function(Jinja) {')
+	def generate(self, templates=None, source=None, workers=None, runtime=None):
+		self.begin_bundle()
+		if runtime is not None:
+			# helpers come from a separately loaded runtime of this version
+			self.begin('if (Jinja.runtime !== %s) {' % dumps(runtime))
+			self.line('throw new Error("jinja2js runtime %s is required, not " + Jinja.runtime);'
+			          % runtime)
+			self.end('}')
+		elif self.profile and 'profiled' not in self.scope.utils.declared:
+			# templates are wrapped as they are defined, before the helpers
+			self.scope.utils.declared.add('profiled')
+			self.generate_helper('utils.profiled')
 		if source:
 			self.generate_template(source=source)
-		if templates:
-			for name in templates:
-				self.generate_template(name=name)
-		for name in self.scope.templates.declaration:
-			self.generate_template(name=name.value)  # todo: fix this
-		# fixme: deep dependencies
-		for name in self.scope.tests.declaration:
-			self.generate_test(name)
-		for name in self.scope.filters.declaration:
-			self.generate_filter(name)
-		for name in self.scope.utils.declaration:
-			self.generate_utils(name)
+		for fragment in self.collect_templates(templates, workers):
+			self.write_fragment(fragment)
+		if runtime is None:
+			self.generate_helpers()
+		self.end_bundle()
+
+	def generate_runtime(self, runtime):
+		self.begin_bundle()
+		for include, registry in registries:
+			for name, helper in getattr(self.environment, registry).items():
+				# inline helpers are part of the templates
+				if isinstance(helper, Function):
+					getattr(self.scope, include).use(name)
+		self.generate_helpers()
+		self.line('Jinja.runtime = %s;' % dumps(runtime))
+		self.end_bundle()
+
+	def begin_bundle(self):
+		self.line('var Jinja = Jinja || {templates:{}, filters:{}, tests:{}, utils:{}};')
+		self.begin('(function(Jinja) {')
+		if self.minify:
+			self.line('var _F = Jinja.filters, _T = Jinja.tests, _U = Jinja.utils, '
+			          '_J = Jinja.templates;')
+
+	def end_bundle(self):
 		self.end('}(Jinja));')
 
+	def generate_helpers(self):
+		# helpers of a passed scope are loaded already and can be aliased
+		aliases = {}
+		for include, registry in registries:
+			registry = getattr(self.environment, registry)
+			for name in sorted(getattr(self.scope, include).declared):
+				if name in registry:
+					aliases.setdefault((include, registry[name]), name)
+		depends = set()
+		for include, _ in registries:
+			for name in getattr(self.scope, include).declaration:
+				depends.add('%s.%s' % (include, name))
+		for depend in resolve_helpers(self.environment, depends):
+			include, name = depend.split('.')
+			# helpers reached through other helpers may be declared already
+			if depend not in depends and name in getattr(self.scope, include).declared:
+				continue
+			getattr(self.scope, include).declared.add(name)
+			self.generate_helper(depend, aliases)
+
 	def generate_template(self, name=None, source=None):
-		name, filename, ast = _get_template(self.environment, name, source)
+		if name is not None:
+			self.scope.templates.declared.add(name)
+			self.scope.templates.undeclared.discard(name)
+		fragment = self.compile_template(name, source)
+		fragment.use(self.scope)
+		self.write_fragment(fragment)
+
+	def write_fragment(self, fragment):
+		self.fragments.append(fragment)
+		self.stream.write(_utf8(fragment.code))
+
+	def collect_templates(self, templates=None, workers=None):
+		if not isinstance(workers, Workers):
+			# a number of processes, started for this call
+			with Workers(self.environment, workers) as workers:
+				return self.collect_templates(templates, workers)
+		fragments = []
+		# templates of a passed scope are loaded already
+		names = [name for name in templates or ()
+		         if name not in self.scope.templates.declared]
+		while names or self.scope.templates.undeclared:
+			for name in names:
+				self.scope.templates.declared.add(name)
+				self.scope.templates.undeclared.discard(name)
+			for fragment in self.compile_templates(names, workers):
+				fragment.use(self.scope)
+				fragments.append(fragment)
+			# templates reached through extends/include, in a stable order
+			names = sorted(self.scope.templates.declaration)
+		return fragments
+
+	def compile_template(self, name=None, source=None):
+		return self.compile_sources([_get_source(self.environment, name, source)])[0]
+
+	def compile_templates(self, names, workers=None):
+		sources = [_get_source(self.environment, name) for name in names]
+		return self.compile_sources(sources, workers)
+
+	def compile_sources(self, sources, workers=None):
+		args, fragments, keys = [], [], []
+		for name, filename, source, uptodate in sources:
+			args.append((name, filename, source, self.indentation, self.options))
+			self.uptodate[name] = uptodate
+			fragment = key = None
+			if self.cache is not None:
+				key = cache_key(self.environment, name, source, self.options)
+				value = self.cache.load(key)
+				if value is not None:
+					fragment = Fragment.load(value)
+					if not self.fresh(fragment):
+						fragment = None
+			fragments.append(fragment)
+			keys.append(key)
+
+		missing = [i for i, fragment in enumerate(fragments) if fragment is None]
+		if workers is not None:
+			results = workers.map([args[i] for i in missing])
+		else:
+			results = [None] * len(missing)
+
+		for i, result in zip(missing, results):
+			if result is not None:
+				fragments[i] = Fragment.load(result)
+			else:
+				# compile in process, this also reraises errors of workers
+				fragments[i] = _compile(self.environment, *args[i])
+			if keys[i] is not None:
+				self.cache.dump(keys[i], fragments[i].dump())
+		return fragments
+
+	def fresh(self, fragment):
+		for name, checksum in fragment.sources.items():
+			try:
+				_, _, source, _ = _get_source(self.environment, name)
+			except TemplateNotFound:
+				return False
+			if source_checksum(source) != checksum:
+				return False
+		return True
+
+	def flatten(self, node):
+		# the template with the blocks of its constant chain of extends in
+		# place, None if the chain has to be resolved at runtime
+		chain, sources = [node], {}
+		while True:
+			extends = [n for n in chain[-1].body if isinstance(n, nodes.Extends)]
+			if not extends:
+				if chain[-1].find(nodes.Extends) is not None:
+					return None
+				break
+			template = extends[0].template
+			if len(extends) > 1 or not isinstance(template, nodes.Const) \
+			   or template.value == self.name or template.value in sources:
+				return None
+			name, filename, source, _ = _get_source(self.environment, template.value)
+			sources[name] = source_checksum(source)
+			chain.append(_merge_outputs(_parse(self.environment, name, filename, source)))
+		if len(chain) == 1:
+			return None
+		macros = set()
+		for tree in chain:
+			if _free_names(tree) & set(['super', 'self']):
+				return None
+			names = set(n.name for n in tree.find_all(nodes.Macro))
+			if names & macros:
+				return None
+			macros.update(names)
+		blocks = {}
+		for tree in reversed(chain):
+			blocks.update((n.name, n) for n in tree.find_all(nodes.Block))
+		self.sources.update(sources)
+		return chain, _Flatten(blocks).visit(_clone(chain[-1]))
+
+	def visit_source(self, name, filename, source):
+		ast = _parse(self.environment, name, filename, source)
 		if not isinstance(ast, nodes.Template):
 			raise TypeError('Can\'t compile non template nodes')
 		self.name = name
 		self.filename = filename
-		self.visit(ast)
-
-	def generate_filter(self, name):
-		if name not in self.environment.filters_js:
-			raise TypeError('Can\'t find javascript realization of filter %s' % name)
-		filter = self.environment.filters_js[name]
-		filter.register_depends(self.scope)
-		self.line('Jinja.filters.%s = %s;' % (name, filter.body))
-
-	def generate_test(self, name):
-		if name not in self.environment.tests_js:
-			raise TypeError('Can\'t find javascript realization of test %s' % name)
-		test = self.environment.tests_js[name]
-		test.register_depends(self.scope)
-		self.line('Jinja.tests.%s = %s;' % (name, test.body))
-
-	def generate_utils(self, name):
-		if name not in self.environment.utils_js:
-			raise TypeError('Can\'t find javascript realization of %s' % name)
-		util = self.environment.utils_js[name]
-		util.register_depends(self.scope)
-		self.line('Jinja.utils.%s = %s;' % (name, util.body))
+		self.visit(_merge_outputs(ast))
+
+	def generate_helper(self, depend, aliases=None):
+		include, name = depend.split('.')
+		helper = get_helper(self.environment, depend)
+		if aliases is not None and (include, helper) in aliases:
+			bits = include, name, include, aliases[include, helper]
+			self.line('Jinja.%s.%s = Jinja.%s.%s;' % bits)
+			return
+		if aliases is not None:
+			aliases[include, helper] = name
+		body = _compact(helper.body) if self.minify else helper.body
+		self.line('Jinja.%s.%s = %s;' % (include, name, body))
 
 	## shortcuts ##
 
@@ -149,15 +824,35 @@ class CodeGenerator(NodeVisitor):
 		self.indentation -= step
 
 	def write(self, x):
-		if self.new_line:
+		if self.minify:
+			for name, alias in short_registries:
+				x = x.replace(name, alias)
+		self.emit(x)
+
+	def emit(self, x):
+		if self.new_line and not self.minify:
 			self.stream.write('    ' * self.indentation)
-		self.stream.write(x)
+		self.stream.write(_utf8(x))
 		self.new_line = False
 
 	def line(self, x):
-		self.write(x + '\n')
+		self.write(x if self.minify else x + '\n')
 		self.new_line = True
 
+	def literal(self, value):
+		# minified, strings are raw utf-8 apart from the line separators
+		# javascript doesn't allow in string literals
+		if not self.minify:
+			self.emit(dumps(value))
+			return
+		code = dumps(value, ensure_ascii=False)
+		self.emit(code.replace(u'\u2028', '\\u2028').replace(u'\u2029', '\\u2029'))
+
+	def ident(self, name):
+		if self.minify:
+			return short_names[name]
+		return name
+
 	def begin(self, x):
 		self.line(x)
 		self.indent()
@@ -166,14 +861,82 @@ class CodeGenerator(NodeVisitor):
 		self.outdent()
 		self.line(x)
 
+	## buffers ##
+
+	def begin_buffer(self, frame, size=0):
+		buffer = self.options['buffer']
+		if buffer == 'string':
+			self.line('var %s = "", _t;' % frame.buffer)
+		elif buffer == 'chunks':
+			self.line('var %s = new Array(%d), %sn = 0;' % (frame.buffer, size, frame.buffer))
+		else:
+			self.line('var %s = [];' % frame.buffer)
+
+	def write_buffer(self, frame, chunks):
+		# chunks are literal strings, nodes or callables writing the code
+		def write(chunk):
+			if isinstance(chunk, basestring):
+				self.literal(chunk)
+			elif isinstance(chunk, nodes.Node):
+				self.visit(chunk, frame)
+			else:
+				chunk()
+
+		buffer = self.options['buffer']
+		if buffer == 'string':
+			# keep the string context and render null and undefined as
+			# empty strings, like join() does
+			self.write('%s += ' % frame.buffer)
+			if not isinstance(chunks[0], basestring):
+				self.write('"" + ')
+			for i, chunk in enumerate(chunks):
+				if i:
+					self.write(' + ')
+				if isinstance(chunk, basestring):
+					write(chunk)
+				else:
+					self.write('((_t = ')
+					write(chunk)
+					self.write(') == null ? "" : _t)')
+			self.line(';')
+		elif buffer == 'chunks':
+			for chunk in chunks:
+				self.write('%s[%sn++] = ' % (frame.buffer, frame.buffer))
+				write(chunk)
+				self.line(';')
+		else:
+			self.write('%s.push(' % frame.buffer)
+			for i, chunk in enumerate(chunks):
+				if i:
+					self.write(', ')
+				write(chunk)
+			self.line(');')
+
+	def buffer_value(self, buffer):
+		if self.options['buffer'] == 'string':
+			return buffer
+		return '%s.join("")' % buffer
+
+	def end_buffer(self, frame):
+		self.line('return %s;' % self.buffer_value(frame.buffer))
+
 	def fail(self, msg, lineno):
 		raise TemplateAssertionError(msg, lineno, self.name, self.filename)
 
 	## visitors ##
 
+	def profiled(self, kind, name):
+		# functions compiled with profiling on are wrapped to count their
+		# calls, see `Jinja.utils.profiled`
+		self.scope.utils.use('profiled')
+		self.write('Jinja.utils.profiled("%s", %s, ' % (kind, dumps(name)))
+
 	def jsmacro(self, node, frame):
 
-		self.write('"%s": function(ctx, tmpl' % node.name)
+		self.write('var %s = ' % self.macros[node.name][0])
+		if self.profile:
+			self.profiled('macro', '%s:%s' % (self.name, node.name))
+		self.write('function(ctx, tmpl')
 
 		args = set()
 		for n in node.args:
@@ -184,61 +947,196 @@ class CodeGenerator(NodeVisitor):
 		frame = Frame(frame.eval_ctx, frame)
 		frame.identifiers.declared = args
 		self.begin(') {')
+		self.bind_includes(node.body, args)
 
 		for arg, val in zip(node.args[-len(node.defaults):], node.defaults):
+			# only missing arguments take the default, falsy ones are kept
+			self.write('if (')
 			self.visit(arg, frame)
-			self.write(' = ')
+			self.write(' === undefined) ')
 			self.visit(arg, frame)
-			self.write(' || ')
+			self.write(' = ')
 			self.visit(val, frame)
 			self.write(';')
 
-		self.line('var %s = [];' % frame.buffer)
+		self.begin_buffer(frame, _chunk_count(node.body))
 		for n in node.body:
 			self.visit(n, frame)
 
-		self.line('return %s.join("");' % frame.buffer)
-		self.end('}')
+		self.end_buffer(frame)
+		self.end(self.profile and '});' or '};')
+
+	def inlined(self, node, frame):
+		# the output of a small macro called with plain arguments can be
+		# written straight into the buffer of the caller
+		if not self.environment.optimized or self.profile or not isinstance(node, nodes.Call) \
+		   or not isinstance(node.node, nodes.Name) or node.kwargs or node.dyn_args \
+		   or node.dyn_kwargs or frame.eval_ctx.autoescape != self.autoescape:
+			return None
+		name = node.node.name
+		if name not in self.macros or name in frame.identifiers.declared:
+			return None
+		macro = self.macros[name][1]
+		if not _inlinable(macro.body) or len(node.args) > len(macro.args):
+			return None
+		args = dict(zip([arg.name for arg in macro.args], node.args))
+		defaults = zip(macro.args[len(macro.args) - len(macro.defaults):], macro.defaults)
+		free = set()
+		for n in macro.body:
+			free.update(_free_names(n))
+		for arg, default in defaults:
+			if arg.name not in args:
+				args[arg.name] = default
+				free.update(_free_names(default))
+		if len(args) != len(macro.args) or not all(_simple(arg) for arg in args.values()):
+			return None
+		if free.difference(args) & frame.identifiers.declared:
+			return None
+		for arg, default in defaults:
+			value = args[arg.name]
+			if value is not default and not isinstance(value, nodes.Const):
+				# like the called macro, take the default for undefined values
+				test = nodes.Test(value, 'defined', [], [], None, None)
+				args[arg.name] = nodes.CondExpr(test, value, default) \
+					.set_lineno(value.lineno).set_environment(self.environment)
+		substitute = _Substitute(args)
+		return [substitute.visit(_clone(n)) for n in macro.body]
 
 	def block(self, node, frame):
 
-		self.begin('"%s": function(ctx, tmpl) {' % node.name)
-		self.line('var %s = [];' % frame.buffer)
+		self.write('"%s": ' % node.name)
+		if self.profile:
+			self.profiled('block', '%s:%s' % (self.name, node.name))
+		self.begin('function(ctx, tmpl) {')
+		self.bind_includes(node.body)
+		self.begin_buffer(frame, _chunk_count(node.body))
 
 		frame = Frame(frame.eval_ctx, frame)
 		for n in node.body:
 			self.visit(n, frame)
 
-		self.line('return %s.join("");' % frame.buffer)
-		self.end('}')
+		self.end_buffer(frame)
+		self.end(self.profile and '})' or '}')
+
+	def bind_includes(self, body, args=()):
+		# templates included in loops are looked up once a call, the ones
+		# registered again are rendered from the next call on
+		self.includes = {}
+		declared = set(args)
+		for n in body:
+			declared.update(name.name for name in n.find_all(nodes.Name) if name.ctx == 'store')
+		for name in _looped_includes(body):
+			if name in self.includes:
+				continue
+			included = self.included(name)
+			if included is not None:
+				free = set()
+				for n in included[0]:
+					free.update(_free_names(n))
+				if not free & declared:
+					# written in place
+					continue
+			var = self.ident('_include') + str(len(self.includes))
+			self.includes[name] = var
+			self.line('var %s = Jinja.templates[%s];' % (var, dumps(name)))
+
+	def included(self, name):
+		# the body of a small constant include, None if it's rendered by
+		# its own template
+		if name not in self.inlines:
+			self.inlines[name] = None
+			if self.options['inline_includes'] and self.environment.optimized:
+				try:
+					name, filename, source, _ = _get_source(self.environment, name)
+				except TemplateNotFound:
+					return None
+				tree = _merge_outputs(_parse(self.environment, name, filename, source))
+				if not tree.find(nodes.Extends) and _inlinable(tree.body):
+					self.inlines[name] = tree.body, source_checksum(source)
+		return self.inlines[name]
 
 	def visit_Include(self, node, frame):
-		self.scope.templates.use(node.template)
-		self.write('%s.push(Jinja.templates[' % frame.buffer)
-		self.visit(node.template, frame)
-		self.line('].render(ctx));')
+		template = node.template
+		if isinstance(template, nodes.Const) and isinstance(template.value, basestring):
+			self.scope.templates.use(template.value)
+			included = self.included(template.value)
+			if included is not None and node.with_context:
+				# written in place only where it renders the same, reading
+				# from the context and not from the local names
+				body, checksum = included
+				free = set()
+				for n in body:
+					free.update(_free_names(n))
+				autoescape = EvalContext(self.environment, template.value).autoescape
+				if autoescape == frame.eval_ctx.autoescape \
+				   and not free & frame.identifiers.declared:
+					self.sources[template.value] = checksum
+					for n in body:
+						self.visit(n, frame)
+					return
+		elif isinstance(template, nodes.Const):
+			self.scope.templates.use(template.value)
+
+		def render():
+			if isinstance(template, nodes.Const) and template.value in self.includes:
+				self.write('%s.render(ctx)' % self.includes[template.value])
+				return
+			self.write('Jinja.templates[')
+			self.visit(template, frame)
+			self.write('].render(ctx)')
+		self.write_buffer(frame, [render])
 
 	def visit_Template(self, node, frame=None):
 
 		frame = Frame(EvalContext(self.environment, self.name))
-		frame.buffer = '_buf'
+		frame.buffer = self.ident('_buf')
 		frame.toplevel = True
 
-		self.begin('Jinja.templates["%s"] = {' % self.name)
+		# a constant chain of extends is compiled into one template
+		flat = self.options['flatten'] and self.flatten(node)
+		if flat:
+			chain, root = flat
+			self.flat = True
+			macros = [n for tree in chain for n in tree.find_all(nodes.Macro)]
+		else:
+			chain, root = [node], node
+			macros = list(node.find_all(nodes.Macro))
+
+		# constant lists tested with `in` become sets created once
+		self.sets = {}
+		for tree in [root] + macros * bool(flat):
+			for compare in tree.find_all(nodes.Compare):
+				for op in compare.ops:
+					if op.op in ('in', 'notin') and _constant_items(op.expr) is not None:
+						self.sets[op] = self.ident('_in') + str(len(self.sets))
+		# macros are local functions called directly
+		self.autoescape = frame.eval_ctx.autoescape
+		self.macros = dict((n.name, (self.ident('_macro_') + n.name, n)) for n in macros)
+		closure = self.sets or macros
+		if closure:
+			self.begin('Jinja.templates["%s"] = (function() {' % self.name)
+			for op, name in sorted(self.sets.items(), key=lambda item: item[1]):
+				self.write('var %s = new Set(' % name)
+				self.literal(_constant_items(op.expr))
+				self.line(');')
+			for n in macros:
+				self.jsmacro(n, frame)
+			self.begin('return {')
+		else:
+			self.begin('Jinja.templates["%s"] = {' % self.name)
 		self.write('"macros": ')
-		macros = list(node.find_all(nodes.Macro))
 		if not macros:
 			self.write('{},')
 		else:
-			self.begin('{')
-			for i, n in enumerate(macros):
-				self.jsmacro(n, frame)
-				if i != len(macros) - 1:
-					self.write(',')
-			self.end('},')
+			self.write('{')
+			for i, name in enumerate(sorted(self.macros)):
+				if i:
+					self.write(', ')
+				self.write('"%s": %s' % (name, self.macros[name][0]))
+			self.line('},')
 
 		self.write('"blocks": ')
-		blocks = list(node.find_all(nodes.Block))
+		blocks = list(root.find_all(nodes.Block))
 		if not blocks:
 			self.write('{},')
 		else:
@@ -249,31 +1147,59 @@ class CodeGenerator(NodeVisitor):
 					self.write(',')
 			self.end('},')
 
-		self.begin('"render": function(ctx, tmpl) {')
+		self.write('"render": ')
+		if self.profile:
+			self.profiled('template', self.name)
+		self.begin('function(ctx, tmpl) {')
 
 		extends = node.find(nodes.Extends)
-		if extends:
-			self.scope.templates.use(extends.template)
+		if flat:
+			# children extending this template at runtime take the chain
+			self.scope.templates.use(extends.template.value)
+			self.parents.append(extends.template.value)
+			self.scope.utils.use('extend')
+			self.line('if (tmpl !== undefined) return Jinja.templates[%s]'
+			          '.render(ctx, Jinja.utils.extend(this, tmpl));' % dumps(extends.template.value))
+			self.line('tmpl = this;')
+			self.bind_includes(root.body)
+			self.begin_buffer(frame, _chunk_count(root.body))
+			for n in root.body:
+				self.visit(n, frame)
+			self.end_buffer(frame)
+		elif extends:
+			if isinstance(extends.template, nodes.Const):
+				self.scope.templates.use(extends.template.value)
+				self.parents.append(extends.template.value)
+			# the blocks of this template and of its children go up the chain
+			self.scope.utils.use('extend')
 			self.write('return Jinja.templates[')
 			self.visit(extends.template, frame)
-			self.write('].render(ctx, this);')
+			self.line('].render(ctx, Jinja.utils.extend(this, tmpl));')
 		else:
 			self.scope.utils.use('extend')
 			self.line('tmpl = Jinja.utils.extend(this, tmpl);')
-			self.line('var %s = [];' % frame.buffer)
+			self.bind_includes(node.body)
+			self.begin_buffer(frame, _chunk_count(node.body))
 			for n in node.body:
 				self.visit(n, frame)
-			self.line('return %s.join("");' % frame.buffer)
+			self.end_buffer(frame)
 
-		self.end('}')
+		self.end(self.profile and '})' or '}')
 		self.end('};')
+		if closure:
+			self.end('}());')
 
 	def visit_Const(self, node, frame):
-		self.write(dumps(node.value))
+		self.literal(node.value)
 
 	def visit_Block(self, node, frame):
-		bits = frame.buffer, node.name
-		self.line('%s.push(tmpl.blocks["%s"](ctx, tmpl));' % bits)
+		if self.flat and (node.scoped or not frame.identifiers.declared):
+			# the block sees just the context, unless it's scoped
+			frame = Frame(frame.eval_ctx, frame)
+			for n in node.body:
+				self.visit(n, frame)
+			return
+		self.write_buffer(frame, [lambda: self.write('tmpl.blocks["%s"](ctx, tmpl)' % node.name)])
 
 	def visit_Extends(self, node, frame):
 		pass
@@ -284,16 +1210,14 @@ class CodeGenerator(NodeVisitor):
 	def visit_FilterBlock(self, node, frame):
 
 		local = Frame(EvalContext(self.environment, self.name))
-		local.buffer = '_fbuf'
+		local.buffer = self.ident('_fbuf')
 		local.toplevel = frame.toplevel
 
-		self.line('var %s = [];' % local.buffer)
+		self.begin_buffer(local, _chunk_count(node.body))
 		for n in node.body:
 			self.visit(n, local)
 
-		self.write('%s.push(' % frame.buffer)
-		self.visit_Filter(node.filter, local)
-		self.line(');')
+		self.write_buffer(frame, [lambda: self.visit_Filter(node.filter, local)])
 
 	def visit_Assign(self, node, frame):
 
@@ -310,9 +1234,23 @@ class CodeGenerator(NodeVisitor):
 		self.write(';')
 
 	def visit_Call(self, node, frame):
+		if frame.eval_ctx.autoescape and isinstance(node.node, nodes.Name):
+			# macro results are safe, wherever they are output later
+			self.scope.utils.use('markup')
+			self.write('Jinja.utils.markup(')
+			self.call(node, frame)
+			self.write(')')
+		else:
+			self.call(node, frame)
+
+	def call(self, node, frame):
 
 		if isinstance(node.node, nodes.Name):
-			self.write('tmpl.macros.' + node.node.name)
+			name = node.node.name
+			if name in self.macros and name not in frame.identifiers.declared:
+				self.write(self.macros[name][0])
+			else:
+				self.write('tmpl.macros.' + name)
 			self.write('(ctx, tmpl')
 			if node.args:
 				self.write(', ')
@@ -337,10 +1275,62 @@ class CodeGenerator(NodeVisitor):
 		self.line(';')
 
 	def visit_Output(self, node, frame):
+		children = []
 		for child in node.nodes:
-			self.write('%s.push(' % frame.buffer)
-			self.visit(child, frame)
-			self.line(');')
+			body = self.inlined(child, frame)
+			if body is None:
+				children.append(child)
+			else:
+				for output in body:
+					children.extend(output.nodes)
+		# adjacent literal chunks are joined at compile time
+		chunks = []
+		for child in children:
+			literal = _literal(child, frame.eval_ctx)
+			if literal is None:
+				chunks.append(child)
+			elif chunks and isinstance(chunks[-1], basestring):
+				chunks[-1] += literal
+			else:
+				chunks.append(literal)
+		if frame.eval_ctx.autoescape:
+			chunks = [chunk if isinstance(chunk, basestring) else
+			          (lambda chunk=chunk: self.write_escaped(chunk, frame))
+			          for chunk in chunks]
+		if chunks:
+			self.write_buffer(frame, chunks)
+
+	def write_escaped(self, node, frame):
+		# only values which aren't provably safe are escaped at runtime
+		helper = None
+		if isinstance(node, nodes.Filter) and node.node is not None:
+			helper = self.environment.filters_js.get(node.name)
+		if isinstance(node, nodes.Const) and not isinstance(node.value, basestring):
+			self.visit(node, frame)
+		elif helper is not None and helper.safe:
+			helper.visit(self, node, frame)
+		elif isinstance(node, nodes.Call) and isinstance(node.node, nodes.Name):
+			self.call(node, frame)
+		else:
+			self.scope.filters.use('escape')
+			self.write('Jinja.filters.escape(')
+			self.visit(node, frame)
+			self.write(')')
+
+	def visit_EvalContextModifier(self, node, frame):
+		for keyword in node.options:
+			try:
+				value = keyword.value.as_const(frame.eval_ctx)
+			except nodes.Impossible:
+				self.fail('%s has to be a constant' % keyword.key, node.lineno)
+			setattr(frame.eval_ctx, keyword.key, value)
+
+	def visit_ScopedEvalContextModifier(self, node, frame):
+		saved = frame.eval_ctx.save()
+		self.visit_EvalContextModifier(node, frame)
+		for n in node.body:
+			self.visit(n, frame)
+		frame.eval_ctx.revert(saved)
 
 	def visit_Name(self, node, frame):
 		if node.name in frame.identifiers.declared:
@@ -352,7 +1342,7 @@ class CodeGenerator(NodeVisitor):
 
 	def visit_TemplateData(self, node, frame):
 		val = node.as_const(frame.eval_ctx)
-		self.write(dumps(val))
+		self.literal(val)
 
 	def visit_CondExpr(self, node, frame):
 		self.write('(')
@@ -396,34 +1386,103 @@ class CodeGenerator(NodeVisitor):
 			self.visit(node.arg, frame)
 			self.write(']')
 
-	def visit_Operand(self, node, frame):
-		self.write(' %s ' % operators[node.op])
-		self.visit(node.expr, frame)
-
-	def for_targets(self, node, loopvar, frame, pre=''):
+	def for_targets(self, node, item, frame):
 
 		if isinstance(node, nodes.Tuple):
 			for i, target in enumerate(node.items):
 				frame.identifiers.declared.add(target.name)
 				self.write('var ')
 				self.visit(target, frame)
-				bits = pre + loopvar, pre + loopvar, i
-				self.write(' = %s.iter[%s.i][%s];' % bits)
+				self.write(' = %s[%s];' % (item, i))
 		else:
 			frame.identifiers.declared.add(node.name)
 			self.write('var ')
 			self.visit(node, frame)
-			self.write(' = %s.iter[%s.i];' % (pre + loopvar, pre + loopvar))
+			self.write(' = %s;' % item)
+
+	def loop_index(self, loopvar):
+		return self.ident('_loopindex') + loopvar[len(self.ident('_loopvar')):]
+
+	def plain_for(self, node, frame, loopvar):
+		# without references to `loop` the loop object is not needed
+		index = self.loop_index(loopvar)
+		frame.identifiers.declared.update((loopvar, index))
+		self.write('var %s = ' % loopvar)
+		self.visit(node.iter, frame)
+		self.line(';')
+
+		vars = (index, index, loopvar, index)
+		self.begin('for (var %s = 0; %s < %s.length; %s++) {' % vars)
+		self.for_targets(node.target, '%s[%s]' % (loopvar, index), frame)
+		if node.test:
+			self.write('if (!(')
+			self.visit(node.test, frame)
+			self.write(')) continue;')
+
+		for n in node.body:
+			self.visit(n, frame)
+		self.end('}')
 
 	def visit_For(self, node, frame):
 
 		before = frame.identifiers.declared.copy()
-		loopvar = frame.special_name('_loopvar')
-		if loopvar.endswith('0') and 'loop' in frame.identifiers.declared:
-			self.line('var _pre_loop = loop;')
+		loopvar = frame.special_name(self.ident('_loopvar'))
+		fields = _loop_fields(node.body)
+		test_fields = _loop_fields([node.test] if node.test else [])
+		if not fields and not test_fields:
+			self.plain_for(node, frame, loopvar)
+			frame.identifiers.declared = before
+			return
+
+		if not self.loops and 'loop' in frame.identifiers.declared:
+			self.line('var %s = loop;' % self.ident('_pre_loop'))
 
 		frame.identifiers.declared.add(loopvar)
 		frame.identifiers.declared.add('loop')
+		if node.test and not test_fields:
+			self.fused_for(node, frame, loopvar, fields)
+		else:
+			self.filtered_for(node, frame, loopvar)
+
+		self.loops.append(loopvar)
+		for n in node.body:
+			self.visit(n, frame)
+		self.loops.pop()
+
+		self.end('}')
+		frame.identifiers.declared = before
+		if self.loops:
+			self.line('loop = %s;' % self.loops[-1])
+		elif 'loop' in frame.identifiers.declared:
+			self.line('loop = %s;' % self.ident('_pre_loop'))
+
+	def fused_for(self, node, frame, loopvar, fields):
+		# the filter runs inline, the loop object counts the passed items
+		index = self.loop_index(loopvar)
+		frame.identifiers.declared.add(index)
+		self.scope.utils.use('loop')
+		self.line('var %s = Jinja.utils.loop(' % loopvar)
+		self.visit(node.iter, frame)
+		if fields & length_fields:
+			# the length is counted when it is read
+			self.write(', function(%s) {' % self.ident('_item'))
+			self.for_targets(node.target, self.ident('_item'), frame)
+			self.write('return ')
+			self.visit(node.test, frame)
+			self.write(';}')
+		self.write(');')
+		self.line('%s.i = -1;' % loopvar)
+
+		vars = (index, index, loopvar, index)
+		self.begin('for (var %s = 0; %s < %s.iter.length; %s++) {' % vars)
+		self.for_targets(node.target, '%s.iter[%s]' % (loopvar, index), frame)
+		self.write('if (!(')
+		self.visit(node.test, frame)
+		self.write(')) continue;')
+		self.line('%s.i++;' % loopvar)
+		self.line('loop = %s;' % loopvar)
+
+	def filtered_for(self, node, frame, loopvar):
 		if node.test:
 			self.scope.utils.use('loop')
 			self.line('var f%s = Jinja.utils.loop(' % loopvar)
@@ -432,12 +1491,12 @@ class CodeGenerator(NodeVisitor):
 
 			vars = (loopvar,) * 4
 			self.line('var g%s = [];' % loopvar)
-			self.begin('for (f%s.i = 0; f%s.i < f%s.length; f%s.i++) {' % vars)
+			self.begin('for (f%s.i = 0; f%s.i < f%s.iter.length; f%s.i++) {' % vars)
 
-			self.for_targets(node.target, loopvar, frame, 'f')
-			self.write('if (!')
+			self.for_targets(node.target, 'f%s.iter[f%s.i]' % (loopvar, loopvar), frame)
+			self.write('if (!(')
 			self.visit(node.test, frame)
-			self.write(') continue;')
+			self.write(')) continue;')
 
 			bits = (loopvar,) * 3
 			self.line('g%s.push(f%s.iter[f%s.i]);' % bits)
@@ -452,31 +1511,27 @@ class CodeGenerator(NodeVisitor):
 		self.write(');')
 
 		vars = (loopvar,) * 4
-		self.begin('for (%s.i = 0; %s.i < %s.length; %s.i++) {' % vars)
+		self.begin('for (%s.i = 0; %s.i < %s.iter.length; %s.i++) {' % vars)
 
-		self.for_targets(node.target, loopvar, frame)
+		self.for_targets(node.target, '%s.iter[%s.i]' % (loopvar, loopvar), frame)
 		self.line('loop = %s;' % loopvar)
-		self.line('loop.update();')
-
-		for n in node.body:
-			self.visit(n, frame)
-
-		self.end('}')
-		if loopvar[8:] != '0':
-			self.line('loop = _loopvar%s;' % (int(loopvar[8:]) - 1))
-
-		frame.identifiers.declared = before
-		if loopvar.endswith('0') and 'loop' in frame.identifiers.declared:
-			self.line('loop = _pre_loop;')
 
 	def visit_Filter(self, node, frame):
 		if node.name not in self.environment.filters_js:
-			raise TypeError('Can\'t find javascript realization of filter %s' % node.name)
-		self.environment.filters_js[node.name].visit(self, node, frame)
+			raise CompileError('Can\'t find javascript realization of filter %s' % node.name)
+		helper = self.environment.filters_js[node.name]
+		if frame.eval_ctx.autoescape and helper.safe:
+			# keep the result from being escaped once more on output
+			self.scope.utils.use('markup')
+			self.write('Jinja.utils.markup(')
+			helper.visit(self, node, frame)
+			self.write(')')
+		else:
+			helper.visit(self, node, frame)
 
 	def visit_Test(self, node, frame):
 		if node.name not in self.environment.tests_js:
-			raise TypeError('Can\'t find javascript realization of test %s' % node.name)
+			raise CompileError('Can\'t find javascript realization of test %s' % node.name)
 		self.environment.tests_js[node.name].visit(self, node, frame)
 
 	def visit_Not(self, node, frame):
@@ -485,15 +1540,19 @@ class CodeGenerator(NodeVisitor):
 		self.write(')')
 
 	def visit_Concat(self, node, frame):
-		self.scope.utils.use('strjoin')
-		self.write('Jinja.utils.strjoin(')
+		if frame.eval_ctx.autoescape:
+			self.scope.utils.use('markupjoin')
+			self.write('Jinja.utils.markupjoin([')
+		else:
+			self.scope.utils.use('strjoin')
+			self.write('Jinja.utils.strjoin(')
 		first = True
 		for n in node.nodes:
 			if not first:
 				self.write(', ')
 			self.visit(n, frame)
 			first = False
-		self.write(')')
+		self.write('], "")' if frame.eval_ctx.autoescape else ')')
 
 	def visit_If(self, node, frame):
 
@@ -517,21 +1576,83 @@ class CodeGenerator(NodeVisitor):
 		self.end('}')
 
 	def visit_Compare(self, node, frame):
-
-		if node.ops[0].op not in ('in', 'notin'):
-			self.visit(node.expr, frame)
-			for op in node.ops:
-				self.visit(op, frame)
+		if len(node.ops) == 1:
+			self.comparison(node.expr, node.ops[0], node.ops[0].expr, frame)
 			return
+		# `a < b < c` is `a < b && b < c`, operands used twice and not
+		# simple are evaluated once as arguments of a closure
+		operands, params, args = [node.expr], [], []
+		for op in node.ops[:-1]:
+			if _simple(op.expr):
+				operands.append(op.expr)
+			else:
+				params.append(self.ident('_cmp') + str(len(params)))
+				args.append(op.expr)
+				operands.append(params[-1])
+		operands.append(node.ops[-1].expr)
+		if params:
+			self.write('(function(%s) { return ' % ', '.join(params))
+		self.write('(')
+		for i, op in enumerate(node.ops):
+			if i:
+				self.write(' && ')
+			self.write('(')
+			self.comparison(operands[i], op, operands[i + 1], frame)
+			self.write(')')
+		self.write(')')
+		if params:
+			self.write('; }(')
+			for i, arg in enumerate(args):
+				if i:
+					self.write(', ')
+				self.visit(arg, frame)
+			self.write('))')
+
+	def operand(self, node, frame):
+		# operands of chained comparisons can be names of closure arguments
+		if isinstance(node, basestring):
+			self.write(node)
+		else:
+			self.visit(node, frame)
 
-		oper = node.ops[0]
-		if oper.op == 'notin':
+	def unwrapped(self, node, frame, unwrap=True):
+		# safe strings are String objects, compared or tested they have to
+		# be the plain strings they wrap
+		if unwrap and frame.eval_ctx.autoescape and not isinstance(node, nodes.Const):
+			self.scope.utils.use('unwrap')
+			self.write('Jinja.utils.unwrap(')
+			self.operand(node, frame)
+			self.write(')')
+		else:
+			self.operand(node, frame)
+
+	def comparison(self, left, op, right, frame):
+		if op.op not in ('in', 'notin'):
+			equality = op.op in ('eq', 'ne')
+			self.unwrapped(left, frame, equality)
+			self.write(' %s ' % operators[op.op])
+			self.unwrapped(right, frame, equality)
+			return
+		negate = op.op == 'notin'
+		if isinstance(right, nodes.Const) and isinstance(right.value, basestring):
+			self.write('(')
+			self.literal(right.value)
+			self.write('.indexOf(')
+			self.operand(left, frame)
+			self.write(') %s -1)' % ('===' if negate else '!=='))
+			return
+		if negate:
 			self.write('!')
+		if right is op.expr and op in self.sets:
+			self.write('%s.has(' % self.sets[op])
+			self.unwrapped(left, frame)
+			self.write(')')
+			return
 		self.scope.utils.use('contains')
 		self.write('Jinja.utils.contains(')
-		self.visit(node.expr, frame)
+		self.unwrapped(left, frame)
 		self.write(', ')
-		self.visit(oper.expr, frame)
+		self.operand(right, frame)
 		self.write(')')
 
 	def visit_List(self, node, frame):
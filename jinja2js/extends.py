@@ -1,18 +1,86 @@
 # -*- coding: utf-8 -*-
 from json import dumps
-from re import split
+from math import isinf, isnan
+from re import split, findall
 
-__all__ = ['function', 'inline']
+__all__ = ['function', 'inline', 'CompileError']
+
+
+class CompileError(TypeError):
+	# a template using filters or tests which have no javascript realization,
+	# or calling them with wrong arguments
+	pass
+
+
+def _depends(body, depends):
+	depends = depends or ()
+	if not isinstance(depends, (tuple, list)):
+		depends = (depends,)
+	# helpers referenced from the body are dependencies as well
+	found = findall(r'Jinja\.((?:filters|tests|utils)\.\w+)', body)
+	return tuple(sorted(set(depends).union(found)))
+
+
+def _names(names):
+	names = names or ()
+	if not isinstance(names, (tuple, list)):
+		names = (names,)
+	return tuple(names)
+
+
+def _primitive(value):
+	# constants which look and behave the same in python and javascript
+	if isinstance(value, bool):
+		return True
+	if isinstance(value, (int, long)):
+		return abs(value) < 2 ** 53
+	if isinstance(value, float):
+		return not isinf(value) and not isnan(value)
+	if type(value) in (str, unicode):
+		try:
+			if isinstance(value, unicode):
+				value.encode('ascii')
+			else:
+				value.decode('ascii')
+		except UnicodeError:
+			return False
+		return True
+	return False
+
+
+def _fingerprint(helper):
+	items = []
+	for key, value in sorted(vars(helper).items()):
+		if callable(value):
+			value = '%s.%s' % (value.__module__, value.__name__)
+		items.append((key, value))
+	return '%r' % items
+
+
+def _foldable(pure, args, kwargs):
+	# `pure` is either a flag or a guard telling for which arguments the
+	# javascript realization matches the python one
+	if not pure:
+		return False
+	if not all(_primitive(arg) for arg in list(args) + kwargs.values()):
+		return False
+	if callable(pure):
+		return pure(*args, **kwargs)
+	return True
 
 
 class Function(object):
 
-	def __init__(self, body, depends=None, free=False, spec=None, defaults=None, include='filters'):
+	def __init__(self, body, depends=None, free=False, spec=None, defaults=None, include='filters',
+	             pure=False, safe=False, unwrap=None, autoescape=None):
 		self.body = '(%s)' % body
-		depends = depends or ()
-		if not isinstance(depends, (tuple, list)):
-			depends = (depends,)
-		self.depends = depends
+		self.pure = pure
+		self.safe = safe
+		# the utils helper called instead when compiling with autoescape
+		self.autoescape = autoescape
+		# arguments which are looked at as plain strings, not safe ones
+		self.unwrap = _names(unwrap)
+		self.depends = _depends(body, depends)
 		self.include = include
 		self.free = free
 		if not free:
@@ -25,11 +93,11 @@ class Function(object):
 
 	def signature(self, name, args, kwargs):
 		if self.free:
-			if not kwargs:
-				raise TypeError("filter %s got an unexpected keyword arguments" % name)
+			if kwargs:
+				raise CompileError("filter %s takes no keyword arguments" % name)
 			return args
 		if len(self.spec) < len(args) + len(kwargs):
-			raise TypeError("filter %s takes at most %s arguments (%s given)"
+			raise CompileError("filter %s takes at most %s arguments (%s given)"
 			                % (name, len(self.spec), len(args) + len(kwargs)))
 		signature = [None] * len(self.spec)
 		for i, arg in enumerate(args):
@@ -38,10 +106,10 @@ class Function(object):
 			try:
 				i = self.spec.index(kwarg.key)
 			except ValueError:
-				raise TypeError("filter %s got an unexpected keyword argument '%s'"
+				raise CompileError("filter %s got an unexpected keyword argument '%s'"
 				                % (name, kwarg.key))
 			if signature[i] is not None:
-				raise TypeError("filter %s got multiple values for keyword argument '%s'"
+				raise CompileError("filter %s got multiple values for keyword argument '%s'"
 				                % (name, kwarg.key))
 			signature[i] = kwarg.value
 		for name, value in self.defaults:
@@ -56,20 +124,34 @@ class Function(object):
 		for depend in self.depends:
 			scope.use(depend)
 
+	def fingerprint(self):
+		return _fingerprint(self)
+
+	def foldable(self, *args, **kwargs):
+		return _foldable(self.pure, args, kwargs)
+
 	def visit(self, codegen, node, frame):
+		include, name = self.include, node.name
+		if self.autoescape and frame.eval_ctx.autoescape:
+			include, name = 'utils', self.autoescape
 		# register self in dependencies
-		getattr(codegen.scope, self.include).use(node.name)
+		getattr(codegen.scope, include).use(name)
 		# visits
-		codegen.write('Jinja.%s.%s(' % (self.include, node.name))
+		if include == 'filters' and codegen.options['profile']:
+			codegen.profiled('filter', name)
+			codegen.write('Jinja.filters.%s)(' % name)
+		else:
+			codegen.write('Jinja.%s.%s(' % (include, name))
 		# if the filter node is None we are inside a filter block
 		# and want to write to the current buffer
 		if node.node is None:
-			codegen.write('%s.join("")' % frame.buffer)
+			codegen.write(codegen.buffer_value(frame.buffer))
 		else:
 			codegen.write('(')
-			codegen.visit(node.node, frame)
+			codegen.unwrapped(node.node, frame, 'value' in self.unwrap)
 			codegen.write(')')
-		for arg in self.signature(node.name, node.args, node.kwargs):
+		names = () if self.free else self.spec
+		for i, arg in enumerate(self.signature(node.name, node.args, node.kwargs)):
 			codegen.write(', ')
 			if arg is None:
 				codegen.write('undefined')
@@ -77,19 +159,20 @@ class Function(object):
 				codegen.write(arg)
 			else:
 				codegen.write('(')
-				codegen.visit(arg, frame)
+				codegen.unwrapped(arg, frame, i < len(names) and names[i] in self.unwrap)
 				codegen.write(')')
 		codegen.write(')')
 
 
 class Inline(object):
 
-	def __init__(self, body, depends=None, spec=None, defaults=None):
+	def __init__(self, body, depends=None, spec=None, defaults=None, pure=False, safe=False,
+	             unwrap=None):
 		self.tokens = split('{{(\w+)}}', '(%s)' % body)
-		depends = depends or ()
-		if not isinstance(depends, (tuple, list)):
-			depends = (depends,)
-		self.depends = depends
+		self.pure = pure
+		self.safe = safe
+		self.unwrap = _names(unwrap)
+		self.depends = _depends(body, depends)
 		self.spec = spec or ()
 		if not isinstance(self.spec, (tuple, list)):
 			self.spec = (self.spec,)
@@ -99,15 +182,15 @@ class Inline(object):
 
 	def signature(self, name, args, kwargs):
 		if len(self.spec) < len(args) + len(kwargs):
-			raise TypeError("filter %s takes at most %s arguments (%s given)"
+			raise CompileError("filter %s takes at most %s arguments (%s given)"
 			                % (name, len(self.spec), len(args) + len(kwargs)))
 		signature = dict(zip(self.spec, args))
 		for kwarg in kwargs:
 			if kwarg.key not in self.spec:
-				raise TypeError("filter %s got an unexpected keyword argument '%s'"
+				raise CompileError("filter %s got an unexpected keyword argument '%s'"
 				                % (name, kwarg.key))
 			if signature[kwarg.key] is not None:
-				raise TypeError("filter %s got multiple values for keyword argument '%s'"
+				raise CompileError("filter %s got multiple values for keyword argument '%s'"
 				                % (name, kwarg.key))
 			signature[kwarg.key] = kwarg.value
 		for name, value in self.defaults:
@@ -119,7 +202,14 @@ class Inline(object):
 		for depend in self.depends:
 			scope.use(depend)
 
+	def fingerprint(self):
+		return _fingerprint(self)
+
+	def foldable(self, *args, **kwargs):
+		return _foldable(self.pure, args, kwargs)
+
 	def visit(self, codegen, node, frame):
+		self.register_depends(codegen.scope)
 		# visits
 		codegen.write('(')
 		is_output = False
@@ -133,10 +223,10 @@ class Inline(object):
 				# if the filter node is None we are inside a filter block
 				# and want to write to the current buffer
 				if node.node is None:
-					codegen.write('%s.join("")' % frame.buffer)
+					codegen.write(codegen.buffer_value(frame.buffer))
 				else:
 					codegen.write('(')
-					codegen.visit(node.node, frame)
+					codegen.unwrapped(node.node, frame, token in self.unwrap)
 					codegen.write(')')
 				continue
 			arg = signature[token]
@@ -146,7 +236,7 @@ class Inline(object):
 				codegen.write(arg)
 			else:
 				codegen.write('(')
-				codegen.visit(arg, frame)
+				codegen.unwrapped(arg, frame, token in self.unwrap)
 				codegen.write(')')
 		codegen.write(')')
 
@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
+import re
+from decimal import Decimal
+
+from jinja2 import nodes
+
 from extends import function, inline
 
 # todo: light autoescaping: |safe can be use only in the end of output
@@ -9,41 +14,139 @@ from extends import function, inline
 # todo: default arguments: null -> undefined
 
 
+# guards for the constants the javascript realizations agree with jinja on
+
+def _string(value, *args, **kwargs):
+	return isinstance(value, basestring)
+
+
+def _number(value, *args, **kwargs):
+	return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def _center(value, width=80):
+	return _string(value) and isinstance(width, (int, long))
+
+
+def _filesize(value, binary=False):
+	if not _number(value) or value < 0:
+		return False
+	# toFixed() and '%.1f' round exact ties differently
+	base = binary and 1024 or 1000
+	if value < base:
+		return True
+	unit = base * base
+	while value >= unit and unit < base ** 9:
+		unit *= base
+	return (Decimal(base * float(value) / unit) * 10) % 1 != Decimal('0.5')
+
+
+_conversion = re.compile(r'%([0 ]?)([0-9]*)(?:\.([0-9]+))?([fisd%])')
+
+
+def _format_pieces(fmt):
+	pieces, pos = [], 0
+	for conversion in _conversion.finditer(fmt):
+		pieces.append(fmt[pos:conversion.start()])
+		if conversion.group(4) == '%':
+			pieces.append('%')
+		else:
+			pieces.append(conversion.groups())
+		pos = conversion.end()
+	pieces.append(fmt[pos:])
+	return pieces
+
+
+class Format(function):
+
+	# a constant format string is parsed at compile time into a plain
+	# concatenation, the helper only handles the dynamic ones
+	def visit(self, codegen, node, frame):
+		if (not isinstance(node.node, nodes.Const) or not isinstance(node.node.value, basestring)
+		    or node.kwargs or node.dyn_args or node.dyn_kwargs):
+			return function.visit(self, codegen, node, frame)
+		pieces = _format_pieces(node.node.value)
+		args = list(node.args)
+		if len([piece for piece in pieces if isinstance(piece, tuple)]) != len(args):
+			return function.visit(self, codegen, node, frame)
+		# adjacent literals are merged, the result always starts with a string
+		merged = ['']
+		for piece in pieces:
+			if isinstance(piece, tuple) or isinstance(merged[-1], tuple):
+				merged.append(piece)
+			else:
+				merged[-1] += piece
+		merged = [piece for piece in merged if piece != ''] or ['']
+		if isinstance(merged[0], tuple):
+			merged.insert(0, '')
+		codegen.write('(')
+		for i, piece in enumerate(merged):
+			if i:
+				codegen.write(' + ')
+			if not isinstance(piece, tuple):
+				codegen.literal(piece)
+				continue
+			pad, width, precision, type = piece
+			if width:
+				codegen.scope.use('utils.formatvalue')
+				codegen.write('Jinja.utils.formatvalue(')
+				codegen.visit(args.pop(0), frame)
+				codegen.write(', "%s", %s, "%s", %s)' % (type, precision or 'undefined', pad, width))
+			elif type == 'f':
+				codegen.write('parseFloat(')
+				codegen.visit(args.pop(0), frame)
+				codegen.write(').toFixed(%s)' % (precision or 6))
+			elif type in 'id':
+				codegen.write('parseInt(')
+				codegen.visit(args.pop(0), frame)
+				codegen.write(')')
+			else:
+				codegen.write('(')
+				codegen.visit(args.pop(0), frame)
+				codegen.write(')')
+		codegen.write(')')
+
+
 default_filters = {
-	"safe": inline("{{value}}"),
+	"safe": inline("{{value}}", safe=True),
 	"attr": inline("{{value}}[{{name}}]", spec='name'),
-	"length": inline("{{value}}.length"),
+	"length": inline("{{value}}.length", pure=_string),
 
-	"abs": inline("Math.abs({{value}})"),
+	"abs": inline("Math.abs({{value}})", pure=_number),
 	"int": inline("Math.floor({{value}}) || {{default}}", spec="default", defaults={'default': 0}),
 	"float": inline("parseFloat({{value}}) || {{default}}", spec="default", defaults={'default': 0.0}),
 
 	"string": inline("{{value}}.toString()"),
 
-	"lower": inline("{{value}}.toLowerCase()"),
-	"upper": inline("{{value}}.toUpperCase()"),
+	"lower": inline("{{value}}.toLowerCase()", pure=_string),
+	"upper": inline("{{value}}.toUpperCase()", pure=_string),
 
-	"trim": inline("{{value}}.replace(/^\s+|\s+$/g, '')"),
+	"trim": inline("{{value}}.replace(/^\s+|\s+$/g, '')", pure=_string),
 	"wordcount": inline("{{value}}.split(/\s+/g).length"),
 	"replace": inline("{{value}}.split({{old}}).join({{new}})", spec=('old', 'new')),
 
 	"urlencode": function("""function(value) {
+        var quote = function(v) {
+        	return encodeURIComponent(v).replace(/[!'()*~]/g, function(c) {
+        		return '%' + c.charCodeAt(0).toString(16).toUpperCase();
+        	}).replace(/%2F/g, '/');
+        };
         if (value instanceof Array) {
         	var r = [];
         	for (var i in value) {
-        		r.push(encodeURIComponent(value[i][0]) + "=" + encodeURIComponent(value[i][1]));
+        		r.push(quote(value[i][0]) + "=" + quote(value[i][1]));
         	}
         	return r.join('&amp;');
         }
         if (typeof value == "object") {
         	var r = [];
         	for (var i in value) {
-        		r.push(encodeURIComponent(i) + "=" + encodeURIComponent(value[i]));
+        		r.push(quote(i) + "=" + quote(value[i]));
         	}
         	return r.join('&amp;');
         }
-        return encodeURIComponent(value);
-    }"""),
+        return quote(value);
+    }""", pure=_string, safe=True),
 
 	"json": inline('JSON.stringify({{value}})'),
 
@@ -55,24 +158,24 @@ default_filters = {
         	return arr;
         }
         if (attr) {
-            r = [];
+            var r = [];
             for (var i in arr) {
             	r.push(arr[i][attr])
             }
-            return r.join(del);
+            arr = r;
         }
         return arr.join(del);
-    }""", spec=('d', 'attribute'), defaults={'d': '', 'attribute': None}),
+    }""", spec=('d', 'attribute'), defaults={'d': '', 'attribute': None}, autoescape='safejoin'),
 
 	"title": function("""function(value) {
-      	return value.replace(/[a-zA-Z]+/g, function(v) {
+      	return value.replace(/[^-\\s]+/g, function(v) {
              return v.charAt(0).toUpperCase() + v.substring(1).toLowerCase();
         });
-  	}"""),
+  	}""", pure=_string),
 
 	"capitalize": function("""function(value) {
         return value.charAt(0).toUpperCase() + value.substring(1).toLowerCase();
-    }"""),
+    }""", pure=_string),
 
 	"first": function("""function(value) {
         return typeof(value) == 'string' ? value.charAt(0) : value[0];
@@ -86,9 +189,38 @@ default_filters = {
         return value[Math.floor(Math.random() * value.length)];
     }"""),
 
-	"escape": function("""function(s) {
-		return s.toString().replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&#34;').replace("'", '&#39;');
-	}"""),
+	"escape": function("""function() {
+		// replacements indexed by char code, one scan from the first match
+		var table = [], special = /[&<>"']/;
+		table[38] = '&amp;';
+		table[60] = '&lt;';
+		table[62] = '&gt;';
+		table[34] = '&#34;';
+		table[39] = '&#39;';
+		return function(s) {
+			if (typeof(s) == 'number' || typeof(s) == 'boolean') return s;
+			if (s == null) return '';
+			if (s.__safe__) return s;
+			s = s.toString();
+			var match = special.exec(s);
+			if (!match) return s;
+			var out = '', last = 0, r;
+			for (var i = match.index; i < s.length; i++) {
+				r = table[s.charCodeAt(i)];
+				if (r !== undefined) {
+					if (last != i) out += s.substring(last, i);
+					out += r;
+					last = i + 1;
+				}
+			}
+			return last != s.length ? out + s.substring(last) : out;
+		};
+	}()""", safe=True),
+
+	# escapes safe strings as well
+	"forceescape": function("""function(s) {
+		return Jinja.filters.escape(s == null ? s : s.toString());
+	}""", safe=True),
 
 	"striptags": function("""function(s) {
         return s.toString().replace(/(<!--.*?-->|<[^>]*>)/g, ' ').replace(/\\s+/g, ' ').trim();
@@ -118,8 +250,9 @@ default_filters = {
 	}""", spec=('linecount', 'fill_with')),
 
 	"center": function("""function(s, width) {
-		var pre = Math.floor((width - s.length) / 2);
-		var post = Math.ceil((width - s.length) / 2);
+		var margin = width - s.length;
+		var pre = Math.floor(margin / 2) + (margin & width & 1);
+		var post = margin - pre;
 		var buf = [];
 		for (var i = 0; i < pre; i++) {
 			buf.push(' ');
@@ -129,7 +262,7 @@ default_filters = {
 			buf.push(' ');
 		}
 		return buf.join('');
-	}""", spec='width', defaults={'width': 80}),
+	}""", spec='width', defaults={'width': 80}, pure=_center),
 
 	"default": function("""function(val, alt, bool) {
 		if (!bool) {
@@ -158,55 +291,28 @@ default_filters = {
 	"filesizeformat": function("""function(val, binary) {
 		var bytes = parseFloat(val);
 		var base = binary ? 1024 : 1000;
-		var middle = binary ? 'i' : '';
-		if (bytes < base) {
-			var multi = bytes == 1 ? '' : 's';
-			return Jinja.filters.format("%i Byte%s", bytes, multi);
-		} else if (bytes < base * base) {
-			return Jinja.filters.format("%.1f K%sB", bytes / base, middle);
-		} else if (bytes < base * base * base) {
-			return Jinja.filters.format("%.1f M%sB", bytes / (base * base), middle);
+		var prefixes = binary ? ['KiB', 'MiB', 'GiB', 'TiB', 'PiB', 'EiB', 'ZiB', 'YiB']
+		                      : ['kB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB'];
+		if (bytes == 1) {
+			return '1 Byte';
+		} else if (bytes < base) {
+			return parseInt(bytes) + ' Bytes';
 		}
-		return Jinja.filters.format("%.1f G%sB", bytes / (base * base * base), middle);
-	}""", spec='binary', defaults={'binary': False}, depends='filters.format'),
-
-	"format": function("""function(fmt) {
-		var vals = Array.prototype.slice.call(arguments, 1);
-		var regex = new RegExp('\%([0 ]?)((?:[0-9]+)?)(\.[0-9]+)?([fis%])');
-		while (regex.test(fmt)) {
-			var parts = regex.exec(fmt);
-			var ext = parts[1] ? parts[1] : ' ';
-			var wantlen = parseInt(parts[2]);
-			var type = parts[0].substring(parts[0].length - 1);
-			var val = vals.shift();
-			if (type == "f") {
-				val = parseFloat(val);
-				if (parts[3]) {
-					val = val.toFixed(parseInt(parts[3].substring(1)));
-				} else {
-					val = val.toString();
-				}
-				if (val.length < wantlen) {
-					val = Jinja.utils.strmul(ext, wantlen - val.length) + val;
-				}
-				fmt = fmt.replace(parts[0], val);
-			} else if (type == "i") {
-				val = parseInt(val).toString();
-				if (val.length < wantlen) {
-					val = Jinja.utils.strmul(ext, wantlen - val.length) + val;
-				}
-				fmt = fmt.replace(parts[0], val);
-			} else if (type == "s") {
-				if (val.length < wantlen) {
-					val = Jinja.utils.strmul(ext, wantlen - val.length) + val;
-				}
-				fmt = fmt.replace(parts[0], val.toString());
-			} else if (type == "%") {
-				fmt = fmt.replace("%%", "%");
+		var unit = base;
+		for (var i = 0; i < prefixes.length; i++) {
+			unit *= base;
+			if (bytes < unit || i == prefixes.length - 1) {
+				return (base * bytes / unit).toFixed(1) + ' ' + prefixes[i];
 			}
 		}
-		return fmt;
-	}""", free=True, depends='utils.strmul'),
+	}""", spec='binary', defaults={'binary': False}, pure=_filesize),
+
+	"format": Format("""function(fmt) {
+		var vals = arguments, n = 1;
+		return fmt.replace(/%([0 ]?)([0-9]*)(?:\.([0-9]+))?([fisd%])/g, function(spec, pad, width, precision, type) {
+			return type == '%' ? '%' : Jinja.utils.formatvalue(vals[n++], type, precision, pad, width);
+		});
+	}""", free=True),
 
 	"groupby": function("""function(ls, attr) {
 		var groups = {};
@@ -250,16 +356,28 @@ default_filters = {
 	}"""),
 
 	"reverse": function("""function(r) {
+		// strings are reversed by code points, not by utf-16 units
+		if (typeof(r) == "string" || r instanceof String) {
+			return Array.from(r.valueOf()).reverse().join('');
+		}
 		var c = r.slice(0);
 		c.reverse();
 		return c;
 	}"""),
 
-	"round": function("""function(val) {
-		var num = arguments[1] ? arguments[1] : 0;
-		var mul = num ? num * 10 : 1;
-		return Math.round(val * mul) / mul;
-	}"""),
+	"round": function("""function(val, precision, method) {
+		if (method != 'common' && method != 'ceil' && method != 'floor') {
+			throw new Error("method must be common, ceil or floor");
+		}
+		var mul = Math.pow(10, Math.abs(precision));
+		var round = method == 'common' ? function(x) {
+			return x < 0 ? -Math.round(-x) : Math.round(x);
+		} : Math[method];
+		if (precision < 0) {
+			return round(val / mul) * mul;
+		}
+		return round(val * mul) / mul;
+	}""", spec=('precision', 'method'), defaults={'precision': 0, 'method': 'common'}),
 
 	"slice": function("""function(ls, num, fill) {
 		var ssize = Math.floor(ls.length / num);
@@ -351,16 +469,17 @@ default_filters = {
 		var tmp = [];
 		for (var k in d) {
 			if (d[k] === null || d[k] === undefined) continue;
-			tmp.push(Jinja.filters.format('%s="%s"', Jinja.filters.escape(k), Jinja.filters.escape(d[k])));
+			tmp.push(Jinja.filters.escape(k) + '="' + Jinja.filters.escape(d[k]) + '"');
 		}
 		var res = (space ? ' ' : '') + tmp.join(' ');
 		return res;
-	}""", spec='autospace', defaults={'autospace': True}, depends=('filters.escape', 'filters.format'))
+	}""", spec='autospace', defaults={'autospace': True}, depends='filters.escape',
+	   safe=True)
 }
 
 # synonyms
 default_filters['count'] = default_filters['length']
-default_filters['forceescape'] = default_filters['e'] = default_filters['escape']
+default_filters['e'] = default_filters['escape']
 default_filters['d'] = default_filters['default']
 
 # i do not want to imitate `pprint`. so this is an acceptable alternative
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import os
+from hashlib import sha1
+from json import dump, load
+
+from jinja2.exceptions import TemplateNotFound
+
+from compiler import source_checksum, registries, get_helper
+
+__all__ = ['DependencyGraph']
+
+
+def helper_checksum(environment, depend, seen=None):
+	try:
+		helper = get_helper(environment, depend)
+	except TypeError:
+		return None
+	checksum = sha1(helper.fingerprint())
+	# helpers calling other helpers change together with them
+	seen = seen or set([depend])
+	for sub in helper.depends:
+		if sub not in seen:
+			seen.add(sub)
+			checksum.update('|%s' % helper_checksum(environment, sub, seen))
+	return checksum.hexdigest()
+
+
+class DependencyGraph(object):
+
+	def __init__(self, filename=None):
+		self.filename = filename
+		self.templates = {}
+		self.helpers = {}
+		self.bundles = {}
+		self.runtime = None
+		if filename is not None and os.path.exists(filename):
+			with open(filename) as f:
+				data = load(f)
+			self.templates = data['templates']
+			self.helpers = data['helpers']
+			self.bundles = data['bundles']
+			self.runtime = data.get('runtime')
+
+	def save(self, filename=None):
+		filename = filename or self.filename
+		with open(filename, 'w') as f:
+			dump({'templates': self.templates,
+			      'helpers': self.helpers,
+			      'bundles': self.bundles,
+			      'runtime': self.runtime}, f, indent=1, sort_keys=True)
+
+	def update(self, fragment):
+		node = dict(fragment.depends)
+		node['parents'] = fragment.parents
+		node['checksum'] = fragment.checksum
+		self.templates[fragment.name] = node
+
+	def update_helpers(self, environment):
+		self.helpers = {}
+		for name in self.templates:
+			for depend in self.helper_depends(name):
+				self.helpers[depend] = helper_checksum(environment, depend)
+
+	def helper_depends(self, name):
+		node = self.templates[name]
+		for include, _ in registries:
+			for helper in node[include]:
+				yield '%s.%s' % (include, helper)
+
+	def dependencies(self, names):
+		seen, stack = set(), list(names)
+		while stack:
+			name = stack.pop()
+			if name in seen:
+				continue
+			seen.add(name)
+			if name in self.templates:
+				stack.extend(self.templates[name]['templates'])
+		return seen
+
+	def dependents(self, names):
+		reverse = {}
+		for name, node in self.templates.items():
+			for depend in node['templates']:
+				reverse.setdefault(depend, set()).add(name)
+		seen, stack = set(), list(names)
+		while stack:
+			name = stack.pop()
+			if name in seen:
+				continue
+			seen.add(name)
+			stack.extend(reverse.get(name, ()))
+		return seen
+
+	def changed(self, environment):
+		changed = set()
+		for name, node in self.templates.items():
+			try:
+				source, _, _ = environment.loader.get_source(environment, name)
+			except TemplateNotFound:
+				changed.add(name)
+				continue
+			if source_checksum(source) != node['checksum']:
+				changed.add(name)
+			elif any(helper_checksum(environment, depend) != self.helpers.get(depend)
+			         for depend in self.helper_depends(name)):
+				changed.add(name)
+		return changed
+
+	def stale_bundles(self, bundles, changed):
+		affected = self.dependents(changed)
+		stale = set()
+		for bundle, templates in bundles.items():
+			if self.bundles.get(bundle) != sorted(templates):
+				stale.add(bundle)
+			elif not all(name in self.templates for name in templates):
+				stale.add(bundle)
+			elif affected & self.dependencies(templates):
+				stale.add(bundle)
+		return stale
@@ -2,10 +2,25 @@
 from extends import inline, function
 
 
+# guards for the constants the javascript realizations agree with jinja on
+
+def _integer(value, num=1):
+	return all(isinstance(x, (int, long)) and not isinstance(x, bool) for x in (value, num))
+
+
+def _number(value):
+	return not isinstance(value, bool)
+
+
+def _cased(value):
+	# islower() and isupper() are false for strings without letters
+	return isinstance(value, basestring) and any(c.isalpha() for c in value)
+
+
 default_tests = {
 	"callable": inline("typeof({{value}}) == 'function'"),
-	"number": inline("typeof({{value}}) == 'number'"),
-	"string": inline("typeof({{value}}) == 'string'"),
+	"number": inline("typeof({{value}}) == 'number'", pure=_number),
+	"string": inline("typeof({{value}}) == 'string'", pure=True, unwrap='value'),
 
 	"sequence": function("""function(value) {
         return typeof(value) == 'string' || typeof(value) == 'object';
@@ -13,13 +28,13 @@ default_tests = {
 
 	"mapping": function("""function(value) {
         return value instanceof Object && !(value instanceof Array);
-	}""", include="tests"),
+	}""", include="tests", unwrap='value'),
 
-	"sameas": inline("{{value}} === {{other}}", spec=('other',)),
+	"sameas": inline("{{value}} === {{other}}", spec=('other',), unwrap=('value', 'other')),
 
-	"odd": inline("!!({{value}} % 2)"),
-	"even": inline("!({{value}} % 2)"),
-	"divisibleby": inline("!({{value}} % {{num}})", spec=('num',)),
+	"odd": inline("!!({{value}} % 2)", pure=_integer),
+	"even": inline("!({{value}} % 2)", pure=_integer),
+	"divisibleby": inline("!({{value}} % {{num}})", spec=('num',), pure=_integer),
 
 	"none": inline("{{value}} === null"),
 	"defined": inline("{{value}} !== undefined"),
@@ -27,10 +42,10 @@ default_tests = {
 
 	"lower": function("""function(value) {
         return value.toLowerCase() == value;
-    }""", include="tests"),
+    }""", include="tests", pure=_cased),
 	"upper": function("""function(value) {
         return value.toUpperCase() == value;
-    }""", include="tests"),
+    }""", include="tests", pure=_cased),
 }
 
 default_tests["iterable"] = default_tests["sequence"]
@@ -74,7 +74,8 @@ class Environment(_Environment):
 
 def suite():
     from jinja2js.testsuite import \
-        core_tags, imports, inheritance, regression, filters, tests
+        core_tags, imports, inheritance, regression, filters, tests, cache, \
+        build, ext
 
     suite = unittest.TestSuite()
     suite.addTest(filters.suite())
@@ -83,5 +84,8 @@ def suite():
     suite.addTest(inheritance.suite())
     suite.addTest(imports.suite())
     suite.addTest(regression.suite())
+    suite.addTest(ext.suite())
+    suite.addTest(cache.suite())
+    suite.addTest(build.suite())
 
     return suite
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from subprocess import Popen, PIPE
+
+from jinja2.testsuite import JinjaTestCase
+from jinja2 import DictLoader, TemplateSyntaxError
+
+from jinja2js import Builder, DependencyGraph, MemoryCache, Scope, Workers
+from jinja2js.extends import function
+from jinja2js.testsuite import Environment, Template, JSTemplateRuntimeError
+from jinja2js.testsuite.cache import CountingEnvironment
+
+LAZY_MAIN = """
+require("vm").runInThisContext(require("fs").readFileSync(process.argv[2], "utf8"));
+Jinja.render("page", {row: "a b"}).then(function(output) {
+    process.stdout.write(JSON.stringify([output, Object.keys(Jinja.loaded)]));
+});
+"""
+
+PROFILE_MAIN = """
+process.stdout.write(JSON.stringify([Jinja.templates.page.render({xs: ["a b", "c"]}),
+                                     JSON.parse(Jinja.profile.dump())]));
+"""
+
+
+class BuilderTestCase(JinjaTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.graph = os.path.join(self.directory, 'graph.json')
+        self.env = CountingEnvironment(loader=DictLoader({
+            'layout': '<{% block body %}{% endblock %}>',
+            'page': '{% extends "layout" %}{% block body %}'
+                    '{% include "row" %}{% endblock %}',
+            'row': '[{{ row|title }}]',
+            'other': '{{ 1 is odd }}'
+        }))
+        self.bundles = {'page.js': ['page'], 'other.js': ['other']}
+        self.cache = MemoryCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def builder(self):
+        return Builder(self.env, self.bundles, self.directory, self.graph,
+                       self.cache)
+
+    def render(self, bundle, name, **ctx):
+        with open(os.path.join(self.directory, bundle)) as f:
+            return Template(name=name, code=f.read()).assert_render(ctx)
+
+    def test_graph(self):
+        self.builder().build()
+        graph = DependencyGraph(self.graph)
+        assert graph.templates['page']['parents'] == ['layout']
+        assert graph.templates['page']['templates'] == ['layout', 'row']
+        assert graph.templates['row']['filters'] == ['title']
+        assert graph.dependents(['row']) == set(['row', 'page'])
+        assert graph.dependencies(['page']) == set(['page', 'layout', 'row'])
+
+    def test_incremental(self):
+        assert self.builder().build() == set(['page.js', 'other.js'])
+        self.render('page.js', 'page', row='a b') == '<[A B]>'
+        assert self.builder().build() == set()
+
+        del self.env.parsed[:]
+        self.env.loader.mapping['row'] = '({{ row|title }})'
+        assert self.builder().build() == set(['page.js'])
+        assert self.env.parsed == ['row']
+        self.render('page.js', 'page', row='a b') == '<(A B)>'
+
+    def test_helper_change(self):
+        self.builder().build()
+        self.env.filters_js['title'] = function('''function(value) {
+            return value.toUpperCase();
+        }''')
+        assert self.builder().build() == set(['page.js'])
+        self.render('page.js', 'page', row='aB c') == '<[AB C]>'
+
+    def test_shared_runtime(self):
+        builder = Builder(self.env, self.bundles, self.directory, self.graph,
+                          self.cache, runtime='runtime.js')
+        assert builder.build() == set(['page.js', 'other.js'])
+        assert builder.build() == set()
+        code = []
+        for filename in 'runtime.js', 'page.js':
+            with open(os.path.join(self.directory, filename)) as f:
+                code.append(f.read())
+        assert 'Jinja.filters.title =' not in code[1]
+        Template(name='page', code=''.join(code)).assert_render(row='a b') == '<[A B]>'
+        self.env.filters_js['lower'] = self.env.filters_js['upper']
+        assert builder.build() == set(['page.js', 'other.js'])
+
+    def test_minified(self):
+        builder = Builder(self.env, self.bundles, self.directory, self.graph,
+                          self.cache, options={'minify': True})
+        builder.build()
+        assert builder.savings == {}
+        self.render('page.js', 'page', row='a b') == '<[A B]>'
+        builder = Builder(self.env, self.bundles, self.directory, self.graph,
+                          self.cache, options={'minify': True}, measure=True)
+        builder.build(changed=['row'])
+        assert builder.savings['page.js'] > 0
+        self.render('page.js', 'page', row='a b') == '<[A B]>'
+
+    def test_watch(self):
+        builder = self.builder()
+        builder.build()
+        with open(os.path.join(self.directory, 'other.js')) as f:
+            other = f.read()
+        assert builder.update() == set()
+
+        self.env.loader.mapping['row'] = '({{ row|title }})'
+        assert builder.update() == set(['page.js'])
+        self.render('page.js', 'page', row='a b') == '<(A B)>'
+        assert builder.update() == set()
+
+        self.env.loader.mapping['row'] = '{% for %}'
+        assert builder.update() == set()
+        assert builder.update() == set()
+        self.env.loader.mapping['row'] = '{{ row|nosuchfilter }}'
+        assert builder.update() == set()
+        self.env.loader.mapping['row'] = '{{ row }}'
+        assert builder.update() == set(['page.js'])
+        self.render('page.js', 'page', row='a b') == '<a b>'
+        with open(os.path.join(self.directory, 'other.js')) as f:
+            assert f.read() == other
+
+    def test_watch_unused(self):
+        builder = self.builder()
+        builder.build()
+        self.env.loader.mapping['unused'] = '1'
+        builder.track(['unused'])
+        self.env.loader.mapping['unused'] = '2'
+        assert builder.changed() == set(['unused'])
+        assert builder.update() == set()
+        assert builder.changed() == set()
+
+    def test_watch_bugs(self):
+        builder = self.builder()
+        builder.build()
+        def build(changed=None):
+            raise TypeError('a bug')
+        builder.build = build
+        self.env.loader.mapping['row'] = '({{ row }})'
+        self.assert_raises(TypeError, builder.update)
+
+    def test_split(self):
+        manifest = self.builder().split(['page', 'other'])
+        assert sorted(manifest) == ['layout', 'other', 'page', 'row']
+        assert manifest['row'][-1:] == ['templates/row.js']
+        assert manifest['page'][-3:] == ['templates/layout.js',
+                                         'templates/page.js',
+                                         'templates/row.js']
+        helpers = set(manifest['page']).difference(manifest['other'])
+        assert len(helpers) == 4
+        code = []
+        for filename in manifest['page']:
+            with open(os.path.join(self.directory, filename)) as f:
+                code.append(f.read())
+        Template(name='page', code=''.join(code)).assert_render(row='a b') == '<[A B]>'
+        with open(os.path.join(self.directory, 'manifest.json')) as f:
+            assert json.load(f)['templates'] == manifest
+
+    def test_lazy_loading(self):
+        self.builder().split(['page', 'other'], loader='loader.js',
+                             base=self.directory + '/')
+        script = os.path.join(self.directory, 'main.js')
+        with open(script, 'w') as f:
+            f.write(LAZY_MAIN)
+        p = Popen(['node', script, os.path.join(self.directory, 'loader.js')],
+                  stdout=PIPE, stderr=PIPE)
+        stdout, stderr = p.communicate()
+        assert not stderr, stderr
+        output, loaded = json.loads(stdout)
+        assert output == '<[A B]>'
+        assert 'templates/other.js' not in loaded
+        assert 'templates/row.js' in loaded
+
+
+class ParallelTestCase(JinjaTestCase):
+
+    def setUp(self):
+        templates = dict(('row%d' % i, '[{{ %d|string }}{%% include "cell" %%}]' % i)
+                         for i in range(8))
+        templates.update(cell='<{{ 3 is odd }}>', broken='{% for %}')
+        self.env = Environment(loader=DictLoader(templates))
+
+    def test_deterministic(self):
+        names = ['row%d' % i for i in range(8)]
+        code = self.env.compile_js(templates=names)
+        assert self.env.compile_js(templates=names, workers=4) == code
+        Template(name='row5', code=code).assert_render() == '[5<true>]'
+
+    def test_errors(self):
+        self.assert_raises(TemplateSyntaxError, self.env.compile_js,
+                           templates=['row0', 'broken'], workers=2)
+
+    def test_shared_pool(self):
+        with Workers(self.env, 2) as workers:
+            # the environment is given to the processes by the initializer
+            args = [('row%d' % i, None, self.env.loader.mapping['row%d' % i], 0, None)
+                    for i in range(2)]
+            assert None not in workers.map(args)
+            pool = workers.pool
+            code = self.env.compile_js(templates=['row2', 'row3'], workers=workers)
+            self.env.compile_js(templates=['row4', 'row5'], workers=workers)
+            assert workers.pool is pool
+        assert workers.pool is None
+        Template(name='row3', code=code).assert_render() == '[3<true>]'
+
+
+class HelpersTestCase(JinjaTestCase):
+
+    def test_aliases(self):
+        env = Environment()
+        code = env.compile_js(source='{{ x|e }}{{ x|escape }}{{ x|forceescape }}')
+        assert code.count("'&#39;'") == 1
+        assert 'Jinja.filters.escape = Jinja.filters.e;' in code
+        Template(code=code).assert_render(x='<') == '&lt;&lt;&lt;'
+
+    def test_deep_dependencies(self):
+        env = Environment()
+        env.filters_js['shout'] = function('''function(value) {
+            return Jinja.tests.lower(value) ? Jinja.filters.indent(value, 2) : value;
+        }''')
+        assert env.filters_js['shout'].depends == ('filters.indent', 'tests.lower')
+        code = env.compile_js(source='{{ "a"|shout }}|{{ "B"|shout }}')
+        assert code.index('Jinja.utils.strmul =') < code.index('Jinja.filters.indent =')
+        assert code.index('Jinja.filters.indent =') < code.index('Jinja.filters.shout =')
+        Template(code=code).assert_render() == 'a|B'
+        env.filters_js['loud'] = function('''function(value) {
+            return Jinja.filters.upper(value);
+        }''')
+        self.assert_raises(TypeError, env.compile_js, source='{{ "a"|loud }}')
+        self.assert_raises(TypeError, env.compile_js_runtime)
+
+    def test_runtime(self):
+        env = Environment()
+        runtime = env.compile_js_runtime()
+        code = env.compile_js(source='{{ x|title }}|{{ x|e }}', runtime=True)
+        assert 'Jinja.filters.title =' not in code
+        assert 'Jinja.filters.title =' in runtime
+        Template(code=runtime + code).assert_render(x='a<b') == 'A<b|a&lt;b'
+        self.assert_raises(JSTemplateRuntimeError, Template(code=code).render)
+        env.filters_js['title'] = env.filters_js['upper']
+        code = env.compile_js(source='{{ x|title }}', runtime=True)
+        self.assert_raises(JSTemplateRuntimeError,
+                           Template(code=runtime + code).render)
+
+    def test_minify(self):
+        env = Environment()
+        source = (u'{% macro m(x) %}<{{ x|upper }}>{% endmacro %}'
+                  u'{% for x in xs|sort %}{{ m(x) }}{{ loop.index }}{% endfor %}'
+                  u'{{ "caf\xe9 \\u2028" }}{{ "%05.1f"|format(n) }}')
+        plain = env.compile_js(source=source)
+        code = env.compile_js(source=source, minify=True)
+        assert 'Jinja.filters.' not in code and 'var _F = Jinja.filters' in code
+        assert '\n\n' not in code and '\n    ' not in code
+        assert u'caf\xe9'.encode('utf-8') in code and '\\u2028' in code
+        assert isinstance(code, str) and len(code) < len(plain)
+        output = Template(code=plain).assert_render(xs=['b', 'a'], n=2)
+        Template(code=code).assert_render(xs=['b', 'a'], n=2) == output
+        stream = tempfile.TemporaryFile()
+        env.compile_js(source=source, minify=True, stream=stream)
+        stream.seek(0)
+        assert stream.read() == code
+        self.assert_raises(TypeError, env.compile_js, source=source, minify='yes')
+
+    def test_minify_locals(self):
+        # the registries are not shadowed by the names of the template
+        env = Environment()
+        source = (u'{% set U = "a b" %}{% set F = x %}{% for J in xs %}'
+                  u'{{ U|title }}{{ F|upper }}{{ J is odd }}{% endfor %}')
+        code = env.compile_js(source=source, minify=True)
+        Template(code=code).assert_render(x='c', xs=[1]) == 'A BCtrue'
+
+    def test_profile(self):
+        env = Environment(loader=DictLoader({
+            'base': '<{% block body %}{% endblock %}>',
+            'page': '{% extends "base" %}{% macro m(x) %}[{{ x|title }}]{% endmacro %}'
+                    '{% block body %}{% for x in xs %}{{ m(x) }}{% endfor %}{% endblock %}',
+        }))
+        plain = env.compile_js(templates=['page'])
+        assert 'profiled' not in plain
+        code = env.compile_js(templates=['page'], profile=True)
+        assert 'Jinja.utils.profiled("filter", "title", Jinja.filters.title)' in code
+        fd, script = tempfile.mkstemp(suffix='.js')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(code + PROFILE_MAIN)
+            p = Popen(['node', script], stdout=PIPE, stderr=PIPE)
+            stdout, stderr = p.communicate()
+        finally:
+            os.remove(script)
+        assert not stderr, stderr
+        output, stats = json.loads(stdout)
+        assert output == '<[A B][C]>'
+        assert sorted(stats) == ['block page:body', 'filter title', 'macro page:m',
+                                 'template base', 'template page']
+        assert stats['filter title']['calls'] == 2
+        assert stats['macro page:m']['bytes'] == 8
+        assert stats['block page:body']['bytes'] == 8
+        macro = stats['macro page:m']
+        assert macro['self'] <= macro['time']
+        self.assert_raises(TypeError, env.compile_js, templates=['page'], profile=1)
+
+    def test_delta(self):
+        env = Environment(loader=DictLoader({
+            'list': '{% for x in xs %}{% include "item" %}{% endfor %}',
+            'item': '[{{ x|title }}]{{ x|e }}',
+            'detail': '{% include "item" %}{{ x|escape }}',
+        }))
+        scope = Scope()
+        first = env.compile_js(templates=['list'], scope=scope)
+        loaded = scope.dump()
+        assert json.loads(loaded) == {'templates': ['item', 'list'],
+                                      'filters': ['e', 'title'],
+                                      'tests': [], 'utils': ['extend']}
+        scope = Scope.load(loaded)
+        second = env.compile_js(templates=['detail'], scope=scope)
+        assert 'Jinja.templates["item"] =' not in second
+        assert 'Jinja.filters.title' not in second
+        assert 'Jinja.utils.extend =' not in second
+        assert 'Jinja.filters.escape = Jinja.filters.e;' in second
+        assert json.loads(scope.dump())['templates'] == ['detail', 'item', 'list']
+        Template(name='detail', code=first + second) \
+            .assert_render(x='<a') == '[<a]&lt;a&lt;a'
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(BuilderTestCase))
+    suite.addTest(unittest.makeSuite(ParallelTestCase))
+    suite.addTest(unittest.makeSuite(HelpersTestCase))
+    return suite
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from jinja2.testsuite import JinjaTestCase
+from jinja2 import DictLoader
+
+from jinja2js import FileSystemCache, SQLiteCache, MemoryCache
+from jinja2js.extends import inline
+from jinja2js.testsuite import Environment, Template
+
+
+class CountingEnvironment(Environment):
+
+    def __init__(self, *args, **kwargs):
+        super(CountingEnvironment, self).__init__(*args, **kwargs)
+        self.parsed = []
+
+    def _parse(self, source, name, filename):
+        self.parsed.append(name)
+        return super(CountingEnvironment, self)._parse(source, name, filename)
+
+
+def make_env(cache):
+    env = CountingEnvironment(loader=DictLoader({
+        'a': '{% include "b" %}|{{ foo|upper }}',
+        'b': '[{{ 42 is even }}]'
+    }))
+    env.js_cache = cache
+    return env
+
+
+class DictCache(object):
+
+    def __init__(self):
+        self.entries = {}
+
+    def load(self, key):
+        return self.entries.get(key)
+
+    def dump(self, key, value):
+        self.entries[key] = value
+
+    def clear(self):
+        self.entries.clear()
+
+
+class CacheTestCase(JinjaTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_cache(self, new_cache):
+        env = make_env(new_cache())
+        code = env.compile_js(templates=['a'])
+        assert sorted(env.parsed) == ['a', 'b']
+        Template(name='a', code=code).assert_render(foo='x') == '[true]|X'
+
+        env = make_env(new_cache())
+        assert env.compile_js(templates=['a']) == code
+        assert env.parsed == []
+
+        env.loader.mapping['b'] = '({{ 42 is even }})'
+        code = env.compile_js(templates=['a'])
+        assert env.parsed == ['b']
+        Template(name='a', code=code).assert_render(foo='x') == '(true)|X'
+
+    def test_filesystem(self):
+        self.check_cache(lambda: FileSystemCache(self.directory))
+
+    def test_sqlite(self):
+        filename = os.path.join(self.directory, 'cache.db')
+        self.check_cache(lambda: SQLiteCache(filename))
+
+    def test_memory(self):
+        cache = MemoryCache()
+        self.check_cache(lambda: cache)
+
+    def test_protocol(self):
+        cache = DictCache()
+        self.check_cache(lambda: cache)
+
+    def test_registry_invalidation(self):
+        env = make_env(MemoryCache())
+        env.compile_js(templates=['a'])
+        env.filters_js['upper'] = inline("{{value}}.toLocaleUpperCase()")
+        code = env.compile_js(templates=['a'])
+        assert env.parsed == ['a', 'b', 'a', 'b']
+        assert 'toLocaleUpperCase' in code
+
+    def test_folded_invalidation(self):
+        env = make_env(MemoryCache())
+        env.loader.mapping['c'] = '{{ "a"|shout }}'
+        env.filters['shout'] = lambda value: value.upper()
+        Template(name='c', code=env.compile_js(templates=['c'])).assert_render() == 'A'
+        env.filters['shout'] = lambda value: value + '!'
+        Template(name='c', code=env.compile_js(templates=['c'])).assert_render() == 'a!'
+        assert env.parsed == ['c', 'c']
+
+    def test_flattened_invalidation(self):
+        env = make_env(MemoryCache())
+        env.loader.mapping.update(base='<{% block x %}{% endblock %}>',
+                                  child='{% extends "base" %}{% block x %}x{% endblock %}')
+        env.compile_js(templates=['child'], flatten=True)
+        env.loader.mapping['base'] = '({% block x %}{% endblock %})'
+        del env.parsed[:]
+        code = env.compile_js(templates=['child'], flatten=True)
+        assert env.parsed == ['child', 'base', 'base']
+        Template(name='child', code=code).assert_render() == '(x)'
+
+    def test_memory_eviction(self):
+        cache = MemoryCache(max_size=10)
+        cache.dump('a', '12345')
+        cache.dump('b', '12345')
+        cache.load('a')
+        cache.dump('c', '12345')
+        assert cache.load('b') is None
+        assert cache.load('a') == cache.load('c') == '12345'
+        assert cache.size == 10
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CacheTestCase))
+    return suite
@@ -2,9 +2,9 @@
 import unittest
 
 from jinja2.testsuite import JinjaTestCase
-from jinja2 import DictLoader
+from jinja2 import DictLoader, Environment as PythonEnvironment
 
-from jinja2js.testsuite import Environment, JSTemplateRuntimeError
+from jinja2js.testsuite import Environment, Template, JSTemplateRuntimeError
 
 env = Environment()
 
@@ -15,6 +15,22 @@ class ForLoopTestCase(JinjaTestCase):
         tmpl = env.from_string('{% for item in seq %}{{ item }}{% endfor %}')
         tmpl.assert_render(seq=range(10)) == '0123456789'
 
+    def test_coalesced_output(self):
+        source = '<li>{{ a }} - {{ b }}{% if true %}!{% endif %}</li>'
+        assert '_buf.push("<li>", ctx.a, " - ", ctx.b, "!</li>");' in env.compile_js(source=source)
+        env.from_string(source).assert_render(a=1, b=2) == '<li>1 - 2!</li>'
+
+    def test_without_loop_object(self):
+        source = ('{% for row in rows if row %}[{% for a, b in row %}'
+                  '{{ loop.index }}{{ a }}{{ b }}{% endfor %}]{% endfor %}')
+        code = env.compile_js(source=source)
+        assert code.count('Jinja.utils.loop(') == 1
+        assert 'loop = _loopvar0' not in code
+        env.from_string(source).assert_render(rows=[[[1, 2]], None, [[3, 4], [5, 6]]]) \
+            == '[112][134256]'
+        code = env.compile_js(source='{% for item in seq %}{{ item }}{% endfor %}')
+        assert 'Jinja.utils.loop' not in code and 'update()' not in code
+
     def test_else(self):
         tmpl = env.from_string('{% for item in seq %}XXX{% else %}...{% endfor %}')
         tmpl.assert_render() == '...'
@@ -93,6 +109,31 @@ class ForLoopTestCase(JinjaTestCase):
                 loop.index }}:{{ item }}]{% endfor %}''')
         tmpl.assert_render() == '[1:0][2:2][3:4][4:6][5:8]'
 
+    def test_fused_loop_filter(self):
+        source = '{% for a, b in seq if a > 1 %}[{{ loop.index }}:{{ b }}]{% endfor %}'
+        code = env.compile_js(source=source)
+        assert 'g_loopvar0' not in code and 'function(_item)' not in code
+        env.from_string(source).assert_render(seq=[[1, 'a'], [2, 'b'], [3, 'c']]) \
+            == '[1:b][2:c]'
+        source = ('{% for item in seq if item is odd %}{{ item }}'
+                  '{% if not loop.last %}/{{ loop.revindex0 }},{% endif %}{% endfor %}')
+        code = env.compile_js(source=source)
+        assert 'g_loopvar0' not in code and 'function(_item)' in code
+        env.from_string(source).assert_render(seq=range(8)) == '1/3,3/2,5/1,7'
+
+    def test_filtered_loop_fields(self):
+        # the fields counting from the end only count the items passing
+        tmpl = env.from_string('{% for x in xs if x is odd %}{{ x }}:{{ loop.length }}/'
+                               '{{ loop.revindex }}/{{ loop.revindex0 }}/{{ loop.last }};'
+                               '{% endfor %}')
+        tmpl.assert_render(xs=[1, 2, 3, 4, 5, 6]) == \
+            '1:3/3/2/false;3:3/2/1/false;5:3/1/0/true;'
+        tmpl.assert_render(xs=[2, 4]) == ''
+        tmpl = env.from_string('{% for x in xs if x > 1 %}{% for y in ys if y %}'
+                               '{{ loop.last }}{% endfor %}{{ loop.length }}{{ loop.last }}|'
+                               '{% endfor %}')
+        tmpl.assert_render(xs=[1, 2, 3], ys=[0, 1, 0, 1, 0]) == 'falsetrue2false|falsetrue2true|'
+
     def test_loop_unassignable(self):
         self.assert_raises(JSTemplateRuntimeError, env.from_string,
                            '{% for loop in seq %}...{% endfor %}')
@@ -198,6 +239,42 @@ class MacrosTestCase(JinjaTestCase):
 {{ m() }}|{{ m('a') }}|{{ m('a', 'b') }}|{{ m(1, 2, 3) }}''')
         tmpl.assert_render() == '||c|d|a||c|d|a|b|c|d|1|2|3|d'
 
+    def test_inlining(self):
+        source = '''\
+{% macro field(name, value='') %}<{{ name }}={{ value }}>{% endmacro %}
+{% for row in rows %}{{ field(row.name) }}{{ field(row.name|upper, 1) }}{% endfor %}'''
+        code = self.env.compile_js(source=source)
+        assert code.count('_macro_field(') == 1
+        assert 'tmpl.macros' not in code
+        self.env.from_string(source).assert_render(rows=[{'name': 'a'}, {'name': 'b'}]) \
+            == '<a=><A=1><b=><B=1>'
+
+    def test_inlining_rendered_environment(self):
+        # the python templates cached by the environment are not copied
+        env = Environment(loader=DictLoader({'page': '{{ 1 }}'}))
+        PythonEnvironment.get_template(env, 'page').render()
+        source = '{% macro m(x) %}[{{ x }}]{% endmacro %}{{ m(y) }}{{ m(2) }}'
+        code = env.compile_js(source=source)
+        assert '_macro_m(' not in code
+        Template(code=code).assert_render(y=1) == '[1][2]'
+
+    def test_inlining_default_names(self):
+        # a default read from the context is not shadowed by the caller
+        tmpl = self.env.from_string('{% macro f(a, b=c) %}{{ a }}{{ b }}{% endmacro %}'
+                                    '{% for c in [5] %}{{ f(1) }}{% endfor %}')
+        tmpl.assert_render(c=9) == '19'
+
+    def test_falsy_arguments(self):
+        # falsy arguments are kept whether the macro is inlined or not
+        calls = '{{ m(0) }}{{ m("") }}{{ m(x) }}{{ m() }}'
+        small = self.env.from_string('{% macro m(a=1) %}[{{ a }}]{% endmacro %}' + calls)
+        assert '_macro_m(' not in small.code
+        small.assert_render(x=0) == '[0][][0][1]'
+        called = self.env.from_string('{% macro m(a=1) %}{% set b = a %}[{{ b }}]{% endmacro %}' +
+                                      calls)
+        assert '_macro_m(' in called.code
+        called.assert_render(x=0) == '[0][][0][1]'
+
     def test_varargs(self):
         tmpl = self.env.from_string('''\
 {% macro test() %}{{ varargs|join('|') }}{% endmacro %}\
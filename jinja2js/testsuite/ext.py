@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from jinja2.testsuite import JinjaTestCase
+
+from jinja2js.testsuite import Environment, Template
+
+
+class AutoEscapeTestCase(JinjaTestCase):
+
+    def test_scoped_setting(self):
+        env = Environment(extensions=['jinja2.ext.autoescape'], autoescape=True)
+        tmpl = env.from_string('''
+            {{ "<HelloWorld>" }}
+            {% autoescape false %}
+                {{ "<HelloWorld>" }}
+            {% endautoescape %}
+            {{ "<HelloWorld>" }}
+        ''')
+        assert tmpl.assert_render().split() == \
+            [u'&lt;HelloWorld&gt;', u'<HelloWorld>', u'&lt;HelloWorld&gt;']
+
+        env = Environment(extensions=['jinja2.ext.autoescape'], autoescape=False)
+        tmpl = env.from_string('''
+            {{ x }}
+            {% autoescape true %}
+                {{ x }}
+            {% endautoescape %}
+            {{ x }}
+        ''')
+        assert tmpl.assert_render(x='<a>').split() == [u'<a>', u'&lt;a&gt;', u'<a>']
+
+    def test_dynamic_values(self):
+        env = Environment(autoescape=True)
+        tmpl = env.from_string('{{ x }}|{{ n }}|{{ none }}|{{ x|safe }}|{{ x|e }}|{{ x|upper }}')
+        tmpl.assert_render(x='<a href="">', n=4) == \
+            '&lt;a href=&#34;&#34;&gt;|4||<a href="">|&lt;a href=&#34;&#34;&gt;|&lt;A HREF=&#34;&#34;&gt;'
+
+    def test_no_redundant_escaping(self):
+        env = Environment(autoescape=True)
+        code = env.compile_js(source='{% macro m(x) %}<{{ x }}>{% endmacro %}'
+                                     '<p>{{ 42 }}{{ "<" }}{{ x|safe }}{{ x|e }}{{ m(x|upper) }}</p>')
+        assert code.count('Jinja.filters.escape(') == 1
+        assert code.count('Jinja.filters.e(') == 1
+        assert '"<p>42&lt;"' in code
+        assert 'Jinja.utils.markup' not in code
+
+    def test_safe_values_stay_safe(self):
+        env = Environment(autoescape=True)
+        tmpl = env.from_string('{% macro m(x) %}<{{ x }}>{% endmacro %}'
+                               '{% set a = x|e %}{% set b = m(x) %}{% set c = x|safe %}'
+                               '{{ a }}|{{ b }}|{{ c }}|{{ a|e }}')
+        tmpl.assert_render(x='&') == '&amp;|<&amp;>|&|&amp;'
+
+    def test_empty_safe_values(self):
+        env = Environment(autoescape=True)
+        tmpl = env.from_string('{% macro m() %}{% endmacro %}'
+                               '{% if x|safe %}T{% else %}F{% endif %}'
+                               '{% if m() %}T{% else %}F{% endif %}')
+        tmpl.assert_render(x='') == 'FF'
+
+    def test_joined_safe_values(self):
+        env = Environment(autoescape=True)
+        tmpl = env.from_string('{% macro m() %}<b>{% endmacro %}'
+                               '{{ m() ~ "!" }}|{{ m() ~ x }}|{{ [m(), m()]|join(",") }}|'
+                               '{{ [m(), x]|join(x) }}|{{ x ~ "!" }}')
+        tmpl.assert_render(x='<') == '<b>!|<b>&lt;|<b>,<b>|<b>&lt;&lt;|&lt;!'
+        tmpl = env.from_string('{{ xs|join(",", attribute="n") }}|{{ x|join }}')
+        tmpl.assert_render(xs=[{'n': '<'}, {'n': 1}], x='<') == '&lt;,1|&lt;'
+
+    def test_plain_joins(self):
+        env = Environment(autoescape=False)
+        code = env.compile_js(source='{{ x ~ y }}|{{ xs|join(",") }}')
+        assert 'Jinja.filters.escape =' not in code
+        assert 'Jinja.utils.markup =' not in code
+        Template(code=code).assert_render(x='<', y=1, xs=['<', 2]) == '<1|<,2'
+
+    def test_forceescape(self):
+        env = Environment(autoescape=True)
+        tmpl = env.from_string('{% set y = x|safe %}{{ y }}|{{ y|forceescape }}|{{ y|e }}')
+        tmpl.assert_render(x='<') == '<|&lt;|<'
+
+    def test_safe_values_compare(self):
+        env = Environment(autoescape=True)
+        tmpl = env.from_string('{% set s = "a"|safe %}{% set t = x|safe %}'
+                               '{{ s is string }}|{{ s is mapping }}|{{ s is sameas "a" }}|'
+                               '{{ ("a"|safe) in ["a", "b"] }}|{{ s in xs }}|{{ s in "abc" }}|'
+                               '{{ s == t }}|{{ s != t }}|{{ s < "b" }}')
+        tmpl.assert_render(x='a', xs=['a']) == \
+            'true|false|true|true|true|true|true|false|true'
+
+    def test_plain_comparisons(self):
+        env = Environment(autoescape=False)
+        code = env.compile_js(source='{{ x is string }}{{ x in ["a", "b"] }}{{ x == y }}')
+        assert 'unwrap' not in code
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(AutoEscapeTestCase))
+    return suite
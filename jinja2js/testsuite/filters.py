@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
+import json
 import unittest
 
 from jinja2.testsuite import JinjaTestCase
 from jinja2 import Markup
 
-from jinja2js.testsuite import Environment
+from jinja2js import CompileError
+from jinja2js.testsuite import Environment, Template, JSTemplateRuntimeError
 
 env = Environment()
 
@@ -48,6 +50,11 @@ class FilterTestCase(JinjaTestCase):
         tmpl = env.from_string('''{{ '<">&'|escape }}''')
         tmpl.assert_render() == '&lt;&#34;&gt;&amp;'
 
+    def test_escape_every_occurrence(self):
+        tmpl = env.from_string('{{ x|e }}|{{ y|e }}|{{ 42|e }}')
+        tmpl.assert_render(x='<a title="\'&\'">&&</a>', y='plain text') == \
+            '&lt;a title=&#34;&#39;&amp;&#39;&#34;&gt;&amp;&amp;&lt;/a&gt;|plain text|42'
+
     def test_striptags(self):
         tmpl = env.from_string('''{{ foo|striptags }}''')
         out = tmpl.assert_render(foo='  <p>just a small   \n <a href="#">'
@@ -108,6 +115,21 @@ class FilterTestCase(JinjaTestCase):
         out = tmpl.assert_render()
         assert out == 'a|b'
 
+    def test_format_arguments(self):
+        tmpl = env.from_string('{{ fmt|format(a, b) }}|{{ "%s"|format(a) }}')
+        tmpl.assert_render(fmt='%s-%s', a=1, b='x') == '1-x|1'
+        self.assert_raises(CompileError, env.compile_js, source='{{ fmt|format(a=1) }}')
+
+    def test_format_specialized(self):
+        source = '{{ "%s: %05.1f%% of %3i|%d"|format(name, ratio, total, total) }}'
+        code = env.compile_js(source=source)
+        assert 'Jinja.filters.format' not in code
+        ctx = dict(name='<a>', ratio=12.345, total=7)
+        env.from_string(source).assert_render(**ctx) == '<a>: 012.3% of   7|7'
+        tmpl = env.from_string('{{ fmt|format(name, ratio, total) }}')
+        tmpl.assert_render(fmt='%s: %05.1f%% of %3i', **ctx) == '<a>: 012.3% of   7'
+        tmpl.assert_render(fmt='%%s %s', **ctx) == '%s <a>'
+
     def test_indent(self):
         tmpl = env.from_string('{{ foo|indent(2) }}|{{ foo|indent(2, true) }}')
         text = '\n'.join([' '.join(['foo', 'bar'] * 2)] * 2)
@@ -165,6 +187,10 @@ class FilterTestCase(JinjaTestCase):
                                '{{ [1, 2, 3]|reverse|json }}')
         tmpl.assert_render() == 'raboof|[3,2,1]'
 
+    def test_reverse_dynamic(self):
+        tmpl = env.from_string('{{ s|reverse }}|{{ l|reverse|join(",") }}|{{ l|join(",") }}')
+        tmpl.assert_render(s=u'ab\U0001f600c', l=[1, 2]) == u'c\U0001f600ba|2,1|1,2'.encode('utf-8')
+
     def test_string(self):
         x = [1, 2, 3, 4, 5]
         tmpl = env.from_string('''{{ obj|string }}''')
@@ -251,6 +277,13 @@ class FilterTestCase(JinjaTestCase):
                                "{{ 21.3|round(-1, 'floor')}}")
         tmpl.assert_render() == '20|30|20', tmpl.assert_render()
 
+    def test_round_dynamic(self):
+        tmpl = env.from_string('{{ x|round }}|{{ y|round(p) }}|{{ y|round(p, m) }}')
+        tmpl.assert_render(x=2.5, y=12.34, p=1, m='floor') == '3|12.3|12.3'
+        tmpl.assert_render(x=-2.5, y=-12.34, p=1, m='floor') == '-3|-12.3|-12.4'
+        tmpl.assert_render(x=0.4, y=1234, p=-2, m='ceil') == '0|1200|1300'
+        self.assert_raises(JSTemplateRuntimeError, tmpl.render, x=1, y=1, p=0, m='up')
+
     def test_xmlattr(self):
         tmpl = env.from_string("{{ {'foo': 42, 'bar': 23, 'fish': none, "
                                "'spam': missing, 'blub:blub': '<?>'}|xmlattr }}")
@@ -356,6 +389,30 @@ class FilterTestCase(JinjaTestCase):
         tmpl.assert_render(o={u"\u203d": 1}) == "%E2%80%BD=1"
         tmpl.assert_render(o={0: 1}) == "0=1"
 
+    def test_folding(self):
+        code = env.compile_js(source='{{ "foo bar"|title }}|{{ 1024|filesizeformat }}|'
+                                     '{{ "ab"|center(5) }}|{{ 1250|filesizeformat }}')
+        assert 'Jinja.filters.title' not in code
+        assert '|1.0 kB|' in code
+        assert 'Jinja.filters.center' not in code
+        assert 'Jinja.filters.filesizeformat(' in code
+        Template(code=code).assert_render() == 'Foo Bar|1.0 kB|  ab |1.3 kB'
+
+    def test_folding_equivalence(self):
+        for source, value in [('x|title', "they're foo-bar\tbaz"),
+                              ('x|capitalize', 'fOO bar'),
+                              ('x|trim', ' \tfoo \n'),
+                              ('x|length', 'foo'),
+                              ('x|urlencode', "a b/c!~'"),
+                              ('x|center(6)', 'abc'),
+                              ('x|center(5)', 'ab'),
+                              ('x|filesizeformat', 1250),
+                              ('x|filesizeformat(true)', 3000000),
+                              ('x|filesizeformat', 10 ** 25),
+                              ('x|abs', -2.5)]:
+            folded = env.from_string('{{ %s }}' % source.replace('x', json.dumps(value), 1))
+            folded.assert_render() == env.from_string('{{ %s }}' % source).assert_render(x=value)
+
 
 def suite():
     suite = unittest.TestSuite()
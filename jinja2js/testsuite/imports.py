@@ -5,7 +5,7 @@ from jinja2.testsuite import JinjaTestCase
 from jinja2 import DictLoader
 from jinja2.exceptions import TemplateNotFound, TemplatesNotFound
 
-from jinja2js.testsuite import Environment
+from jinja2js.testsuite import Environment, Template
 
 
 test_env = Environment(loader=DictLoader(dict(
@@ -113,6 +113,31 @@ class IncludesTestCase(JinjaTestCase):
         )))
         assert env.get_template("main").assert_render() == "123"
 
+    def test_constant_includes(self):
+        env = Environment(loader=DictLoader(dict(
+            main="{% for item in [1, 2] %}{% include 'item' %}{% include 'title' %}"
+                 "{% include 'row' %}{% endfor %}",
+            item="<{{ item }}>",
+            title="{{ title }}",
+            row="{% for x in xs %}({{ x }}){% endfor %}"
+        )))
+        plain = env.compile_js(templates=['main'])
+        code = env.compile_js(templates=['main'], inline_includes=True)
+        assert ' = Jinja.templates["title"];' not in code
+        # reading a local name of the loop, in place it would render differently
+        assert 'var _include0 = Jinja.templates["item"];' in code
+        # the others are looked up once a render, before the loop
+        assert 'Jinja.templates["row"].render' not in plain
+        assert plain.index('var _include2 = Jinja.templates["row"];') < plain.index('for (')
+        assert plain.count('_include2.render(ctx)') == 1
+        for code in plain, code:
+            Template(name='main', code=code) \
+                .assert_render(xs=['a'], item=0, title='T') == '<0>T(a)<0>T(a)'
+        # templates registered again are rendered from then on
+        env.loader.mapping['row'] = '[{{ xs|join }}]'
+        code = plain + env.compile_js(templates=['row'])
+        Template(name='main', code=code).assert_render(xs=['a'], item=0) == '<0>[a]<0>[a]'
+
     def test_unoptimized_scopes(self):
         t = test_env.from_string("""
             {% macro outer(o) %}
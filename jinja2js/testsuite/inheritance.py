@@ -2,9 +2,9 @@
 import unittest
 
 from jinja2.testsuite import JinjaTestCase
-from jinja2 import DictLoader
+from jinja2 import DictLoader, Environment as PythonEnvironment
 
-from jinja2js.testsuite import Environment
+from jinja2js.testsuite import Environment, Template
 
 
 LAYOUTTEMPLATE = '''\
@@ -82,6 +82,29 @@ class InheritanceTestCase(JinjaTestCase):
         tmpl.assert_render() == ('|block 1 from level1|block 5 from '
                                  'level3|block 3 from level4|')
 
+    def test_flattened(self):
+        for name, output in [('level2', '|block 1 from level1|nested block 5 from '
+                                        'level2|nested block 4 from layout|'),
+                             ('level4', '|block 1 from level1|block 5 from '
+                                        'level3|block 3 from level4|')]:
+            code = env.compile_js(templates=[name], flatten=True)
+            fragment = code[code.index('Jinja.templates["%s"]' % name):]
+            fragment = fragment[:fragment.index('Jinja.templates[', 1)]
+            assert 'tmpl.blocks' not in fragment
+            Template(name=name, code=code).assert_render() == output
+        env2 = Environment(loader=DictLoader({
+            'master.html': '{% for item in seq %}[{% block item scoped %}'
+                           '{% endblock %}]{% endfor %}',
+            'child': '{% extends "master.html" %}{% block item %}'
+                     '{{ item }}{% endblock %}'
+        }))
+        code = env2.compile_js(templates=['child'], flatten=True)
+        Template(name='child', code=code).assert_render(seq=range(3)) == '[0][1][2]'
+        # the python templates cached by the environment are not copied
+        PythonEnvironment.get_template(env2, 'master.html').render(seq=[])
+        code = env2.compile_js(templates=['child'], flatten=True)
+        Template(name='child', code=code).assert_render(seq=range(2)) == '[0][1]'
+
     def test_super(self):
         env = Environment(loader=DictLoader({
             'a': '{% block intro %}INTRO{% endblock %}|'
@@ -177,6 +200,18 @@ class InheritanceTestCase(JinjaTestCase):
 
 class BugFixTestCase(JinjaTestCase):
 
+    def test_extend_memoized(self):
+        code = env.compile_js(templates=['level4']) + '''
+        Jinja.templates.check = {render: function() {
+            var t = Jinja.templates, extend = Jinja.utils.extend;
+            var merged = extend(t.level1, t.level2);
+            var same = extend(t.level1, t.level2) === merged;
+            t.level2 = {blocks: t.level2.blocks, render: t.level2.render};
+            return [same, extend(t.level1, t.level2) !== merged,
+                    extend(t.layout, merged).blocks.block5 === t.level2.blocks.block5].join();
+        }};'''
+        Template(name='check', code=code).assert_render() == 'true,true,true'
+
     def test_fixed_macro_scoping_bug(self):
         assert Environment(loader=DictLoader({
             'test.html': '''\
@@ -68,6 +68,20 @@ class CornerTestCase(JinjaTestCase):
         ''')
         t.assert_render(wrapper=23) == '[1][2][3][4]23'
 
+    def test_containment(self):
+        source = ('{{ x in "a.c" }}|{{ x not in ["a", "b"] }}|{{ x in (1, "b") }}|'
+                  '{{ x in d }}|{{ "toString" in d }}|{{ x not in l }}')
+        code = env.compile_js(source=source)
+        assert 'RegExp' not in code and code.count('new Set(') == 2
+        t = env.from_string(source)
+        t.assert_render(x='b', d={'b': 1}, l=['b']) == 'false|false|true|true|false|false'
+        t.assert_render(x='.', d={}, l=[1]) == 'true|true|false|false|false|true'
+
+    def test_chained_comparison(self):
+        t = env.from_string('{{ 1 < x < 3 }}|{{ 1 < x|abs <= 2 > 1 }}|{{ 0 < x == 2 }}')
+        t.assert_render(x=2) == 'true|true|true'
+        t.assert_render(x=-3) == 'false|false|false'
+
 
 class BugTestCase(JinjaTestCase):
 
@@ -239,8 +253,25 @@ class BugTestCase(JinjaTestCase):
             assert False, 'expected error here'
 
 
+class BufferTestCase(JinjaTestCase):
+
+    def test_strategies(self):
+        env = Environment(loader=DictLoader({
+            'row': '[{{ row }}]',
+            'page': '{% macro m(x) %}{{ x }}!{% endmacro %}<{{ 1 }}{{ 2 }}{{ none }}'
+                    '{{ missing }}{% filter upper %}{{ m("a") }}{% include "row" %}'
+                    '{% endfilter %}{% block body %}-{% endblock %}>',
+        }))
+        for buffer in 'array', 'string', 'chunks':
+            code = env.compile_js(templates=['page'], buffer=buffer)
+            Template(name='page', code=code).assert_render(row='b') == '<12A![B]->'
+        self.assert_raises(TypeError, env.compile_js, templates=['page'], buffer='rope')
+        self.assert_raises(TypeError, env.compile_js, templates=['page'], buffers='array')
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(CornerTestCase))
     suite.addTest(unittest.makeSuite(BugTestCase))
+    suite.addTest(unittest.makeSuite(BufferTestCase))
     return suite
@@ -75,6 +75,17 @@ class TestsTestCase(JinjaTestCase):
         tmpl = env.from_string('{{ foo is sameas none }}')
         tmpl.assert_render(foo=None) == 'true'
 
+    def test_folding(self):
+        code = env.compile_js(source='{% if 10 is divisibleby 5 %}a{% endif %}'
+                                     '{% if "foo" is upper %}b{% endif %}'
+                                     '{% if 2.5 is odd %}c{% endif %}')
+        assert 'divisibleby' not in code and 'toUpperCase' not in code
+        assert '_buf.push("b")' not in code
+        assert '(2.5) % 2' in code
+        env.from_string('{{ 10 is divisibleby 3 }}|{{ "123" is lower }}|'
+                        '{{ 42 is number }}|{{ true is number }}') \
+            .assert_render() == 'false|true|true|false'
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -7,18 +7,64 @@ from extends import function
 
 default_utils = {
 
-	"extend": function("""function(base, child) {
-		if (child == undefined) return base;
-		var current = {"blocks": {}};
-		for (var key in base.blocks) {
-			if (!child.blocks[key]) {
-				current.blocks[key] = base.blocks[key];
-			} else {
-				current.blocks[key] = child.blocks[key];
+	# block tables merged down a chain of templates, memoized per pair. a
+	# template registered again is a new object and gets new tables
+	"extend": function("""function() {
+		var tables = new WeakMap();
+		return function(base, child) {
+			if (child == undefined) return base;
+			var merged = tables.get(base);
+			if (!merged) tables.set(base, merged = new WeakMap());
+			var current = merged.get(child);
+			if (!current) {
+				current = {"blocks": {}};
+				for (var key in base.blocks) current.blocks[key] = base.blocks[key];
+				for (var key in child.blocks) current.blocks[key] = child.blocks[key];
+				merged.set(child, current);
 			}
+			return current;
+		};
+	}()""", include='utils'),
+
+	# wraps templates, blocks, macros and filters compiled with profiling on.
+	# the counters are kept in Jinja.profile, times are in milliseconds and
+	# the self time leaves out the time spent in the profiled calls inside
+	"profiled": function("""function() {
+		var profile = Jinja.profile = Jinja.profile || {
+			stats: {},
+			reset: function() { this.stats = {}; },
+			dump: function() { return JSON.stringify(this.stats); }
+		};
+		var now = typeof performance != "undefined" ? function() { return performance.now(); } : Date.now;
+		var inner = [], wrappers = {};
+		function size(value) {
+			return unescape(encodeURIComponent(value)).length;
 		}
-		return current;
-	}""", include='utils'),
+		return function(kind, name, fn) {
+			var key = kind + " " + name;
+			// filters are wrapped at every call site, the wrapper is reused
+			if (wrappers[key] && wrappers[key].fn === fn) return wrappers[key];
+			var wrapper = function() {
+				var start = now(), result;
+				inner.push(0);
+				try {
+					result = fn.apply(this, arguments);
+				} finally {
+					var elapsed = now() - start, nested = inner.pop();
+					if (inner.length) inner[inner.length - 1] += elapsed;
+					var stat = profile.stats[key] || (profile.stats[key] =
+						{kind: kind, name: name, calls: 0, time: 0, self: 0, bytes: 0});
+					stat.calls++;
+					stat.time += elapsed;
+					stat.self += elapsed - nested;
+				}
+				if (typeof result == "string") stat.bytes += size(result);
+				return result;
+			};
+			wrapper.fn = fn;
+			return wrappers[key] = wrapper;
+		};
+	}()""", include='utils'),
 
 	"slice": function("""function(val, start, stop) {
 		if (typeof(val) == "string") {
@@ -28,37 +74,60 @@ default_utils = {
 		}
 	}""", include='utils'),
 
-	"loop": function("""function(iter) {
-		function LoopObject() {
+	"loop": function("""function() {
+		// the fields are computed from the position when they are read,
+		// loops with a filter count their length only when it's needed
+		function LoopObject(iter, filter) {
 			this.iter = iter;
-			this.length = iter.length;
+			this.filter = filter;
 			this.i = 0;
-			this.update = function() {
-				if (arguments.length) this.i = arguments[0];
-				this.index = this.i + 1;
-				this.index0 = this.i;
-				this.revindex = this.length - this.i;
-				this.revindex0 = this.length - this.i - 1;
-				this.first = !this.i;
-				this.last = this.i == this.length - 1;
-			}
-			this.cycle = function() {
-				return arguments[this.index0 % arguments.length];
-			};
 		}
-		return new LoopObject();
+		LoopObject.prototype = {
+			get length() {
+				if (this._length === undefined) {
+					this._length = this.iter.length;
+					if (this.filter) {
+						this._length = 0;
+						for (var i = 0; i < this.iter.length; i++) {
+							if (this.filter(this.iter[i])) this._length++;
+						}
+					}
+				}
+				return this._length;
+			},
+			get index() { return this.i + 1; },
+			get index0() { return this.i; },
+			get revindex() { return this.length - this.i; },
+			get revindex0() { return this.length - this.i - 1; },
+			get first() { return !this.i; },
+			get last() { return this.i == this.length - 1; },
+			cycle: function() {
+				return arguments[this.i % arguments.length];
+			}
+		};
+		return function(iter, filter) {
+			return new LoopObject(iter, filter);
+		};
+	}()""", include='utils'),
+
+	"markup": function("""function(value) {
+		// strings known to be safe html, they are never escaped again.
+		// empty ones stay falsy, there is nothing to escape in them
+		if (value == null || value === '' || value.__safe__) return value;
+		var markup = new String(value);
+		markup.__safe__ = true;
+		return markup;
+	}""", include='utils'),
+
+	"unwrap": function("""function(value) {
+		return value != null && value.__safe__ ? value.valueOf() : value;
 	}""", include='utils'),
 
 	"contains": function("""function(n, hs) {
-		if (hs instanceof Array) {
-			for (var i = 0; i < hs.length; i++) {
-				if (hs[i] == n) return true;
-			}
-			return false;
-		} else if (typeof(hs) == "string") {
-			return !!hs.match(RegExp(n));
-		} else if (typeof(hs) == "object") {
-			return hs[n] !== undefined;
+		if (typeof(hs) == "string" || hs instanceof String || hs instanceof Array) {
+			return hs.indexOf(n) !== -1;
+		} else if (hs !== null && typeof(hs) == "object") {
+			return Object.prototype.hasOwnProperty.call(hs, n);
 		} else {
 			throw new TypeError("containment is undefined: " + n + " in " + JSON.stringify(hs));
 		}
@@ -72,11 +141,101 @@ default_utils = {
 		return buf.join("");
 	}""", include='utils'),
 
+	# the joins of templates compiled with autoescape
+	"markupjoin": function("""function(arr, del) {
+		// like markup, joined to a safe string the others are escaped
+		for (var i = 0; i < arr.length; i++) {
+			if (arr[i] != null && arr[i].__safe__) {
+				var escaped = [];
+				for (var j = 0; j < arr.length; j++) {
+					escaped.push(Jinja.filters.escape(arr[j]));
+				}
+				return Jinja.utils.markup(escaped.join(Jinja.filters.escape(del)));
+			}
+		}
+		return arr.join(del);
+	}""", depends=('filters.escape', 'utils.markup'), include='utils'),
+
+	"safejoin": function("""function(arr, del, attr) {
+		if (!(arr instanceof Array)) {
+			return attr ? arr[attr] : arr;
+		}
+		if (attr) {
+			arr = arr.map(function(item) { return item[attr]; });
+		}
+		return Jinja.utils.markupjoin(arr, del);
+	}""", depends='utils.markupjoin', include='utils'),
+
 	"strmul": function("""function(s, n) {
 		var buf = [];
 		for (var i = 0; i < n; i++) {
 			buf.push(s);
 		}
 		return buf.join('');
-	}""", include='utils')
+	}""", include='utils'),
+
+	# a single `%` conversion of the format filter
+	"formatvalue": function("""function(val, type, precision, pad, width) {
+		if (type == 'f') {
+			val = parseFloat(val).toFixed(precision === undefined ? 6 : precision);
+		} else if (type == 'i' || type == 'd') {
+			val = parseInt(val).toString();
+		} else {
+			val = String(val);
+		}
+		if (width && val.length < width) {
+			val = Jinja.utils.strmul(pad || ' ', width - val.length) + val;
+		}
+		return val;
+	}""", include='utils'),
+
+	# lazy loading of split templates, `Jinja.loader` can be replaced by
+	# any function returning a promise, e.g. one using `import()`
+	"loader": function("""function(file) {
+		return new Promise(function(resolve, reject) {
+			if (typeof document != "undefined") {
+				var script = document.createElement("script");
+				script.src = file;
+				script.async = true;
+				script.onload = resolve;
+				script.onerror = function() {
+					reject(new Error("can't load " + file));
+				};
+				document.head.appendChild(script);
+			} else {
+				// node, templates have to share the global `Jinja`
+				var req = typeof require == "function" ? require : process.mainModule.require;
+				req("fs").readFile(file, "utf8", function(err, code) {
+					if (err) return reject(err);
+					req("vm").runInThisContext(code, file);
+					resolve();
+				});
+			}
+		});
+	}""", include='utils'),
+
+	"load": function("""function(name) {
+		var manifest = Jinja.manifest || {base: "", templates: {}};
+		var files = manifest.templates[name];
+		if (!files) {
+			if (Jinja.templates[name]) return Promise.resolve(Jinja.templates[name]);
+			return Promise.reject(new Error("template not found: " + name));
+		}
+		var loader = Jinja.loader || Jinja.utils.loader;
+		var loaded = Jinja.loaded = Jinja.loaded || {};
+		var pending = [];
+		for (var i = 0; i < files.length; i++) {
+			if (!loaded[files[i]]) loaded[files[i]] = loader(manifest.base + files[i]);
+			pending.push(loaded[files[i]]);
+		}
+		return Promise.all(pending).then(function() {
+			return Jinja.templates[name];
+		});
+	}""", include='utils', depends='utils.loader'),
+
+	"render": function("""function(name, ctx) {
+		return Jinja.utils.load(name).then(function(tmpl) {
+			return tmpl.render(ctx);
+		});
+	}""", include='utils', depends='utils.load')
 }
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import sys
+import json
+from os import path
+from subprocess import Popen, PIPE
+from tempfile import NamedTemporaryFile
+
+sys.path.append(path.dirname(path.abspath(__file__)))
+
+from jinja2 import DictLoader
+from jinja2js.compiler import buffers
+from jinja2js.testsuite import Environment
+
+TEMPLATES = {
+	'layout': '<html><head><title>{% block title %}{% endblock %}</title></head>'
+	          '<body>{% block body %}{% endblock %}</body></html>',
+	'list': '{% extends "layout" %}{% block title %}{{ title|e }}{% endblock %}'
+	        '{% block body %}<ul>{% for row in rows %}'
+	        '<li class="{{ loop.cycle("odd", "even") }}">{{ row.name }} - {{ row.value }}</li>'
+	        '{% endfor %}</ul>{% endblock %}',
+	'table': '<table>{% for row in rows %}<tr>{% for cell in row.cells %}'
+	         '<td>{{ cell }}</td>{% endfor %}</tr>{% endfor %}</table>',
+	'macros': '{% macro field(name, value) %}<input name="{{ name }}" value="{{ value }}">'
+	          '{% endmacro %}<form>{% for row in rows %}{{ field(row.name, row.value) }}'
+	          '{% endfor %}</form>',
+}
+
+CONTEXT = {
+	'title': 'Benchmark <1>',
+	'rows': [{'name': 'row%d' % i, 'value': i, 'cells': range(10)} for i in range(100)],
+}
+
+MAIN = """
+var ctx = %(ctx)s, names = %(names)s, result = {};
+for (var n = 0; n < names.length; n++) {
+	var tmpl = Jinja.templates[names[n]];
+	for (var i = 0; i < 200; i++) tmpl.render(ctx);
+	var start = process.hrtime();
+	for (var i = 0; i < %(rounds)d; i++) tmpl.render(ctx);
+	var time = process.hrtime(start);
+	result[names[n]] = (time[0] * 1e3 + time[1] / 1e6) / %(rounds)d;
+}
+process.stdout.write(JSON.stringify(result));
+"""
+
+ESCAPE = """
+var inputs = %(inputs)s, result = {};
+for (var name in inputs) {
+	var s = inputs[name], escape = Jinja.filters.escape;
+	for (var i = 0; i < 10; i++) escape(s);
+	var start = process.hrtime();
+	for (var i = 0; i < %(rounds)d; i++) escape(s);
+	var time = process.hrtime(start);
+	result[name] = s.length * %(rounds)d / (time[0] * 1e3 + time[1] / 1e6) / 1e3;
+}
+process.stdout.write(JSON.stringify(result));
+"""
+
+# large strings with none, some and only special characters
+ESCAPE_INPUTS = {
+	'plain': 'lorem ipsum dolor sit amet ' * 40000,
+	'html': '<p class="x">Tom & Jerry\'s</p> lorem ipsum ' * 25000,
+	'special': '<>&"\'' * 200000,
+}
+
+
+def run(code):
+	with NamedTemporaryFile(suffix='.js') as f:
+		f.write(code)
+		f.flush()
+		p = Popen(['node', f.name], stdout=PIPE)
+		return json.loads(p.communicate()[0])
+
+
+def bench(code, names, rounds):
+	return run(code + MAIN % {'ctx': json.dumps(CONTEXT), 'names': json.dumps(names),
+	                          'rounds': rounds})
+
+
+def bench_escape(rounds=20):
+	code = Environment().compile_js(source='{{ x|escape }}')
+	result = run(code + ESCAPE % {'inputs': json.dumps(ESCAPE_INPUTS), 'rounds': rounds})
+	print '%-10s%12s' % ('escape', 'MB/s')
+	for name in sorted(result):
+		print '%-10s%12.1f' % (name, result[name])
+
+
+def main(rounds=1000):
+	env = Environment(loader=DictLoader(TEMPLATES))
+	names = sorted(TEMPLATES)
+	results = {}
+	for buffer in buffers:
+		code = env.compile_js(templates=names, buffer=buffer)
+		results[buffer] = bench(code, names, rounds)
+	print '%-10s' % 'template' + ''.join('%12s' % buffer for buffer in buffers)
+	for name in names:
+		print '%-10s' % name + ''.join('%10.4fms' % results[buffer][name] for buffer in buffers)
+	print
+	bench_escape()
+
+
+if __name__ == '__main__':
+	main(*map(int, sys.argv[1:]))